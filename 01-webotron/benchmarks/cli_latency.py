@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Time webotron commands from a cold start, each in a fresh process.
+
+Runs against a local moto server (pip install 'moto[server]').
+
+Usage: python benchmarks/cli_latency.py [RUNS]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+PORT = 5124
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed(command, runs, env):
+    """Return the median seconds command took over runs runs."""
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def main():
+    """Print the median latency of import, --help and a few commands."""
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    env = dict(os.environ, PYTHONPATH=ROOT,
+               AWS_ENDPOINT_URL='http://127.0.0.1:{}'.format(PORT),
+               AWS_DEFAULT_REGION='us-east-1')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.update(env)
+    server = ThreadedMotoServer(port=PORT, verbose=False)
+    server.start()
+    try:
+        boto3.client('s3').create_bucket(Bucket='bench-cli')
+        webotron = [sys.executable, '-m', 'webotron.webotron']
+        with tempfile.TemporaryDirectory() as root:
+            for index in range(50):
+                with open(os.path.join(root, 'f{}.txt'.format(index)),
+                          'w') as f:
+                    f.write(str(index))
+            commands = [
+                ('import', [sys.executable, '-c', 'import webotron.webotron']),
+                ('--help', webotron + ['--help']),
+                ('list-buckets', webotron + ['list-buckets']),
+                ('list-bucket-objects',
+                 webotron + ['list-bucket-objects', 'bench-cli']),
+                ('sync', webotron + ['sync', root, 'bench-cli',
+                                     '--no-etag-cache', '--workers', '8'])
+            ]
+            for name, command in commands:
+                print('{:<22}{:>8.3f}s'.format(name,
+                                               timed(command, runs, env)))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
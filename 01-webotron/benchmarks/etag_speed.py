@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Time get_etag's ETag computation against the old implementation.
+
+Usage: python benchmarks/etag_speed.py [SIZE ...]
+
+Sizes are bytes with an optional K, M or G suffix (default 1M 100M).
+Pass 5G to time a 5 GB file; it needs that much free space in TMPDIR.
+"""
+
+import os
+import sys
+import tempfile
+import time
+from functools import reduce
+from hashlib import md5
+
+from webotron.bucket import BucketManager
+
+BLOCK = os.urandom(1 << 20)
+
+
+def parse_size(text):
+    """Turn '100M' into a number of bytes."""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if text[-1].upper() in units:
+        return int(text[:-1]) * units[text[-1].upper()]
+    return int(text)
+
+
+def old_etag(path, chunk_size=BucketManager.CHUNK_SIZE):
+    """Compute the etag the way get_etag used to."""
+    hashes = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            hashes.append(md5(data))
+    if len(hashes) == 1:
+        return '"{}"'.format(hashes[0].hexdigest())
+    digests = (h.digest() for h in hashes)
+    hash = md5(reduce(lambda x, y: x + y, digests))
+    return '"{}-{}"'.format(hash.hexdigest(), len(hashes))
+
+
+def new_etag(threads):
+    """Return a function computing the etag with threads hash threads."""
+    manager = BucketManager.__new__(BucketManager)
+    manager.hash_threads = threads
+    manager.hash_executor = None
+    return manager.compute_etag
+
+
+def timed(size, name, etag):
+    """Time etag() and print its throughput; return the etag."""
+    started = time.perf_counter()
+    value = etag()
+    elapsed = time.perf_counter() - started
+    print('{:>8} {:<22}{:>8.2f}s {:>8.1f} MB/s'.format(
+        size, name, elapsed, parse_size(size) / elapsed / 1e6))
+    return value
+
+
+def main():
+    """Write each test file and time every implementation on it."""
+    threads = max(os.cpu_count() or 1, 2)
+    for size in sys.argv[1:] or ['1M', '100M']:
+        with tempfile.NamedTemporaryFile() as f:
+            remaining = parse_size(size)
+            while remaining > 0:
+                remaining -= f.write(BLOCK[:remaining])
+            f.flush()
+
+            etags = {
+                timed(size, 'old', lambda: old_etag(f.name)),
+                timed(size, 'readinto', lambda: new_etag(1)(f.name)),
+                timed(size, 'mmap, {} threads'.format(threads),
+                      lambda: new_etag(threads)(f.name))
+            }
+            if len(etags) != 1:
+                print('ETags differ: {}'.format(etags))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""Compare the memory used by a dict manifest and a Manifest.
+
+Usage: python benchmarks/manifest_memory.py [COUNT]
+"""
+
+import gc
+import hashlib
+import sys
+import tracemalloc
+
+from webotron.manifest import Manifest
+
+
+def fake_objects(count):
+    """Yield (key, etag, size) for count made up objects in key order."""
+    for index in range(count):
+        key = 'site/{:03d}/page-{:08d}.html'.format(index % 1000, index)
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        if index % 10:
+            yield key, '"{}"'.format(digest), index
+        else:
+            yield key, '"{}-{}"'.format(digest, index % 40 + 2), index
+
+
+def measure(build, count):
+    """Return bytes still allocated after build(count) returns."""
+    gc.collect()
+    tracemalloc.start()
+    kept = build(count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current
+
+
+def build_dict(count):
+    """Build the manifest the way load_manifest used to."""
+    return {key: etag for key, etag, _ in sorted(fake_objects(count))}
+
+
+def build_manifest(count, spill=False):
+    """Build a packed Manifest."""
+    manifest = Manifest(spill=spill)
+    for key, etag, size in sorted(fake_objects(count)):
+        manifest.add(key, etag, size)
+    manifest.freeze()
+    return manifest
+
+
+def main():
+    """Print the memory used by each representation."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    results = [
+        ('dict', measure(build_dict, count)),
+        ('Manifest', measure(build_manifest, count)),
+        ('Manifest(spill=True)',
+         measure(lambda n: build_manifest(n, spill=True), count))
+    ]
+    baseline = results[0][1]
+    print('{:,} objects'.format(count))
+    for name, used in results:
+        print('{:<22}{:>10.1f} MiB {:>6.1%}'.format(
+            name, used / 2 ** 20, used / baseline))
+
+
+if __name__ == '__main__':
+    main()
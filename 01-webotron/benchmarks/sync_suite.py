@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark sync, load_manifest and get_etag on synthetic trees.
+
+Runs against a local moto server (pip install 'moto[server]'). Every
+request is held for LATENCY seconds before it is sent, like a round trip
+to S3. Each scenario runs in a fresh process, so its peak RSS is its own.
+
+Scenarios:
+- tiny: many tiny files in a few directories.
+- huge: a few files large enough to be uploaded in parts.
+- deep: files spread over deeply nested directories.
+- resync: a tree that was synced before, with 1% of its files changed.
+
+For each scenario it prints files/s, MB/s and AWS API calls per phase,
+and the peak RSS. Trees are made from a fixed seed, so runs with the
+same options sync the same bytes. sync runs once; load_manifest and
+get_etag report the best of --repeat runs.
+
+Save a run with --save-baseline FILE and compare later runs with
+--baseline FILE: a metric that is worse than the baseline by more than
+--tolerance is flagged and the exit status is 1.
+
+Usage: python benchmarks/sync_suite.py [--scenario NAME ...] [--scale N]
+           [--latency SECONDS] [--workers N] [--repeat N]
+           [--baseline FILE] [--save-baseline FILE] [--tolerance FRACTION]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+from webotron.bucket import BucketManager
+from webotron.clients import ClientRegistry
+from webotron.etagcache import EtagCache
+from webotron.stats import Stats
+from webotron.walker import IgnoreRules, walk
+
+PORT = 5125
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED = 1962
+MB = 1 << 20
+
+Scenario = namedtuple('Scenario', ['files', 'sizes', 'depth', 'resync'])
+
+SCENARIOS = {
+    'tiny': Scenario(5000, (1, 512), (1, 1), False),
+    'huge': Scenario(3, (32 * MB, 32 * MB), (0, 0), False),
+    'deep': Scenario(1000, (1, 4096), (8, 24), False),
+    'resync': Scenario(2000, (1024, 16384), (1, 2), True),
+}
+
+# (metric, True if bigger is better) compared against a baseline.
+METRICS = (('files_per_s', True), ('mb_per_s', True), ('api_calls', False))
+
+
+def write_file(path, size, rng):
+    """Write size bytes made from rng to path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        if size <= MB:
+            f.write(rng.randbytes(size))
+            return
+        block = rng.randbytes(MB)
+        for index in range(0, size, MB):
+            f.write(index.to_bytes(8, 'big') + block[8:min(MB, size - index)])
+
+
+def make_tree(root, scenario, scale, rng):
+    """Create scenario's files under root and return their relpaths."""
+    relpaths = []
+    for index in range(max(1, int(scenario.files * scale))):
+        directories = ['d{}'.format(rng.randrange(4 if scenario.depth[1] > 2
+                                                  else 20))
+                       for _ in range(rng.randint(*scenario.depth))]
+        relpath = '/'.join(directories + ['f{}.dat'.format(index)])
+        size = rng.randint(*scenario.sizes)
+        if size > MB:
+            size = max(MB, int(size * min(scale, 1.0)))
+        write_file(os.path.join(root, *relpath.split('/')), size, rng)
+        relpaths.append(relpath)
+    return relpaths
+
+
+def bucket_manager(session, latency):
+    """Return a BucketManager whose requests each take latency longer."""
+    manager = BucketManager(
+        session, clients=ClientRegistry(session, stats=Stats()))
+    if latency:
+        manager.s3.meta.client.meta.events.register_first(
+            'before-send.s3', lambda **kwargs: time.sleep(latency))
+    return manager
+
+
+def measure(session, latency, files, size, run, repeat=1):
+    """Return the rates and API calls of the fastest of repeat runs.
+
+    Each run gets a fresh BucketManager, passed to run.
+    """
+    best = None
+    for _ in range(repeat):
+        manager = bucket_manager(session, latency)
+        started = time.perf_counter()
+        run(manager)
+        seconds = time.perf_counter() - started
+        if best is None or seconds < best[0]:
+            best = seconds, manager.stats.as_dict()['operations']
+    seconds, operations = best
+    return {
+        'seconds': seconds,
+        'files': files,
+        'files_per_s': files / seconds,
+        'mb_per_s': size / MB / seconds,
+        'api_calls': sum(operation['calls'] for operation in operations),
+        'calls': {operation['operation']: operation['calls']
+                  for operation in operations}
+    }
+
+
+def run_scenario(name, args):
+    """Run one scenario in this process and return what it measured."""
+    scenario = SCENARIOS[name]
+    rng = random.Random(SEED)
+    session = boto3.Session(region_name='us-east-1')
+    bucket_name = 'bench-suite-{}'.format(name)
+    session.client('s3').create_bucket(Bucket=bucket_name)
+    phases = {}
+
+    with tempfile.TemporaryDirectory() as work:
+        root = os.path.join(work, 'tree')
+        relpaths = make_tree(root, scenario, args.scale, rng)
+        etag_cache = EtagCache(os.path.join(work, 'etags.sqlite'))
+
+        def sync(manager):
+            manager.etag_cache = etag_cache
+            manager.sync(root, bucket_name, workers=args.workers)
+
+        if scenario.resync:
+            sync(BucketManager(session))
+            for relpath in rng.sample(relpaths, max(1, len(relpaths) // 100)):
+                path = os.path.join(root, *relpath.split('/'))
+                write_file(path, os.path.getsize(path), rng)
+
+        files = [(path, stat) for path, _, stat
+                 in walk(root, IgnoreRules.for_root(root, (), ()))]
+        size = sum(stat.st_size for _, stat in files)
+
+        phases['sync'] = measure(session, args.latency, len(files), size,
+                                 sync)
+        etag_cache.close()
+        phases['load_manifest'] = measure(
+            session, args.latency, len(files), 0,
+            lambda manager: manager.load_manifest(
+                manager.get_bucket(bucket_name), workers=args.workers),
+            args.repeat)
+        phases['get_etag'] = measure(
+            session, args.latency, len(files), size,
+            lambda manager: [manager.get_etag(path, stat)
+                             for path, stat in files],
+            args.repeat)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'files': len(files), 'bytes': size, 'phases': phases,
+        'peak_rss_mb': rss / (MB if sys.platform == 'darwin' else 1024)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print each metric against baseline; return the number that regressed.
+
+    API call counts are compared without tolerance: the same tree should
+    take the same calls.
+    """
+    regressions = 0
+    rows = [(phase, metric, bigger, values[metric],
+             baseline['phases'].get(phase, {}).get(metric))
+            for phase, values in results['phases'].items()
+            for metric, bigger in METRICS]
+    rows.append(('process', 'peak_rss_mb', False, results['peak_rss_mb'],
+                 baseline.get('peak_rss_mb')))
+    for phase, metric, bigger, value, old in rows:
+        if not old:
+            continue
+        change = (value - old) / old
+        allowed = 0 if metric == 'api_calls' else tolerance
+        worse = change < -allowed if bigger else change > allowed
+        regressions += worse
+        print('  {:<14}{:<13}{:>12.1f}{:>12.1f}{:>+9.1%}{}'.format(
+            phase, metric, old, value, change,
+            '  REGRESSION' if worse else ''))
+    return regressions
+
+
+def report(name, results):
+    """Print what one scenario measured."""
+    print('{}: {} files, {:.1f} MB, peak RSS {:.1f} MB'.format(
+        name, results['files'], results['bytes'] / MB,
+        results['peak_rss_mb']))
+    for phase, values in results['phases'].items():
+        print('  {:<14}{:>8.2f}s {:>10.1f} files/s {:>8.1f} MB/s '
+              '{:>6} calls {}'.format(
+                  phase, values['seconds'], values['files_per_s'],
+                  values['mb_per_s'], values['api_calls'],
+                  ' '.join('{}={}'.format(*call)
+                           for call in sorted(values['calls'].items()))))
+
+
+def main():
+    """Run each scenario in its own process and report or compare."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply file counts (and huge sizes) by this')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds added to every request')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='best of this many load_manifest and get_etag '
+                             'runs')
+    parser.add_argument('--baseline', help='compare with this saved run')
+    parser.add_argument('--save-baseline', help='save this run here')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fraction a metric may be worse by')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_scenario(args.run, args)))
+        return
+
+    settings = {'scale': args.scale, 'latency': args.latency,
+                'workers': args.workers}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != settings:
+            print('Warning: the baseline was run with {}'.format(
+                baseline['settings']))
+
+    env = dict(os.environ, PYTHONPATH=ROOT,
+               AWS_ENDPOINT_URL='http://127.0.0.1:{}'.format(PORT))
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=PORT, verbose=False)
+    server.start()
+    scenarios = {}
+    regressions = 0
+    try:
+        for name in args.scenario or SCENARIOS:
+            command = [sys.executable, os.path.abspath(__file__), '--run',
+                       name, '--scale', str(args.scale), '--latency',
+                       str(args.latency), '--workers', str(args.workers),
+                       '--repeat', str(args.repeat)]
+            output = subprocess.run(command, env=env, check=True,
+                                    stdout=subprocess.PIPE).stdout
+            scenarios[name] = json.loads(output)
+            report(name, scenarios[name])
+            if baseline and name in baseline['scenarios']:
+                print('  {:<14}{:<13}{:>12}{:>12}{:>9}'.format(
+                    'phase', 'metric', 'baseline', 'now', 'change'))
+                regressions += compare(scenarios[name],
+                                       baseline['scenarios'][name],
+                                       args.tolerance)
+    finally:
+        server.stop()
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'settings': settings, 'scenarios': scenarios}, f,
+                      indent=2)
+    if regressions:
+        print('{} metrics regressed'.format(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
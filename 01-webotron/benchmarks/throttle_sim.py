@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""Sync against an in-process S3 stand-in that answers with 503 SlowDown.
+
+Runs against moto (pip install moto). A fraction of PutObject and
+UploadPart requests, growing with the number in flight, are answered
+with SlowDown before they reach moto, so the adaptive limiter has
+something to back off from.
+
+Usage: python benchmarks/throttle_sim.py [FILES] [WORKERS] [SAFE_CONCURRENCY]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from moto import mock_aws
+
+from webotron.bucket import BucketManager
+
+SLOWDOWN = (b'<?xml version="1.0" encoding="UTF-8"?><Error>'
+            b'<Code>SlowDown</Code><Message>Please reduce your request rate.'
+            b'</Message></Error>')
+
+
+class RawBody:
+    """A minimal raw HTTP body for AWSResponse."""
+
+    def __init__(self, data):
+        """Create RawBody holding data."""
+        self.data = data
+
+    def stream(self, **kwargs):
+        """Yield the whole body at once."""
+        yield self.data
+
+
+class SlowDownInjector:
+    """Throttle requests when more than safe requests are in flight.
+
+    Every request is held for LATENCY seconds, like a round trip to S3.
+    """
+
+    LATENCY = 0.05
+
+    def __init__(self, safe):
+        """Create SlowDownInjector allowing safe concurrent requests."""
+        self.safe = safe
+        self.in_flight = 0
+        self.injected = 0
+        self.lock = threading.Lock()
+
+    def before_send(self, request, **kwargs):
+        """Answer with 503 SlowDown, or None to send the request on."""
+        with self.lock:
+            self.in_flight += 1
+            over = self.in_flight - self.safe
+            throttle = over > 0 and random.random() < over / self.in_flight
+            if throttle:
+                self.injected += 1
+        try:
+            time.sleep(self.LATENCY)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        if throttle:
+            return AWSResponse(request.url, 503, {}, RawBody(SLOWDOWN))
+        return None
+
+
+def main():
+    """Sync a tree through the injector and print the limiter's stats."""
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    safe = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    with mock_aws(), tempfile.TemporaryDirectory() as root:
+        for index in range(files):
+            with open(os.path.join(root, 'f{}.txt'.format(index)), 'w') as f:
+                f.write(str(index))
+        session = boto3.Session(region_name='us-east-1')
+        session.client('s3').create_bucket(Bucket='bench-throttle')
+
+        manager = BucketManager(session)
+        injector = SlowDownInjector(safe)
+        events = manager.s3.meta.client.meta.events
+        for operation in ('PutObject', 'UploadPart'):
+            events.register_first('before-send.s3.' + operation,
+                                  injector.before_send)
+
+        started = time.perf_counter()
+        results = manager.sync(root, 'bench-throttle', workers=workers)
+        elapsed = time.perf_counter() - started
+        failed = sum(1 for result in results if result.status == 'failed')
+        limiter = manager.limiter
+        print('{} files in {:.2f}s, {} failed'.format(files, elapsed, failed))
+        print('{} SlowDowns injected, {} seen by the limiter'.format(
+            injector.injected, limiter.throttles))
+        print('concurrency {} of {} (lowest {})'.format(
+            limiter.current(), limiter.maximum, limiter.lowest))
+
+
+if __name__ == '__main__':
+    main()
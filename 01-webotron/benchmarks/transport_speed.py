@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""Compare files/sec of the threaded and asyncio sync transports.
+
+Runs against a local moto server (pip install 'moto[server]').
+
+Usage: python benchmarks/transport_speed.py [FILES] [WORKERS] [REQUESTS]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+from webotron.aiotransport import AsyncTransport
+from webotron.bucket import BucketManager
+
+PORT = 5123
+
+
+def make_tree(root, files):
+    """Create files tiny files."""
+    for index in range(files):
+        directory = os.path.join(root, 'd{:02d}'.format(index % 20))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'f{}.txt'.format(index)), 'w') as f:
+            f.write(str(index))
+
+
+def timed(name, files, sync):
+    """Print the files/sec of one sync call."""
+    started = time.perf_counter()
+    results = sync()
+    elapsed = time.perf_counter() - started
+    uploaded = sum(1 for result in results if result.status == 'uploaded')
+    print('{:<10}{:>8} uploaded {:>8.2f}s {:>10.1f} files/s'.format(
+        name, uploaded, elapsed, files / elapsed))
+
+
+def main():
+    """Sync the same tree to two empty buckets, once with each transport."""
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ['AWS_ENDPOINT_URL'] = 'http://127.0.0.1:{}'.format(PORT)
+    server = ThreadedMotoServer(port=PORT, verbose=False)
+    server.start()
+    try:
+        session = boto3.Session(region_name='us-east-1')
+        for name in ('bench-threads', 'bench-async'):
+            session.client('s3').create_bucket(Bucket=name)
+        with tempfile.TemporaryDirectory() as root:
+            make_tree(root, files)
+            timed('threads', files, lambda: BucketManager(session).sync(
+                root, 'bench-threads', workers=workers))
+            timed('async', files, lambda: AsyncTransport(
+                BucketManager(session), requests, workers).sync(
+                    root, 'bench-async'))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
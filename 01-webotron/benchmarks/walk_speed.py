@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Compare the scandir walker with the old recursive Path walk.
+
+Usage: python benchmarks/walk_speed.py [FILES]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from webotron.walker import IgnoreRules, walk
+
+
+def make_tree(root, files):
+    """Create files empty files spread over a few levels of directories."""
+    for index in range(files):
+        directory = os.path.join(root, 'd{:02d}'.format(index % 50),
+                                 'e{:02d}'.format(index // 50 % 40))
+        os.makedirs(directory, exist_ok=True)
+        open(os.path.join(directory, 'f{}.html'.format(index)), 'w').close()
+
+
+def old_walk(root):
+    """Walk root the way sync did before the scandir walker."""
+    def handle_directory(target):
+        for pathitem in target.iterdir():
+            if pathitem.is_dir():
+                yield from handle_directory(pathitem)
+            if pathitem.is_file():
+                yield (str(pathitem.as_posix()),
+                       str(pathitem.relative_to(root).as_posix()),
+                       pathitem.stat())
+    return handle_directory(Path(root))
+
+
+def timed(name, files):
+    """Print how long it took to exhaust the files iterator."""
+    started = time.perf_counter()
+    count = sum(1 for _ in files)
+    print('{:<20}{:>8} files {:>8.2f}s'.format(
+        name, count, time.perf_counter() - started))
+
+
+def main():
+    """Build a tree and time each walker over it."""
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, files)
+        timed('Path.iterdir', old_walk(root))
+        timed('scandir', walk(root))
+        timed('scandir + ignores', walk(root, IgnoreRules.for_root(root)))
+
+
+if __name__ == '__main__':
+    main()
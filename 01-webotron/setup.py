@@ -10,6 +10,7 @@ setup(
     package=['webotron'],
     url='https://github.com/koogled/automating-aws-with-python',
     install_requires=['click','boto3'],
+    extras_require={'async': ['aiobotocore'], 'brotli': ['brotli']},
     entry_points='''
         [console_scripts]
         webotron=webotron.webotron:cli
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the asyncio transport, against a local moto S3 server.
+
+aiobotocore's request bodies cannot be read by moto's in-process mock,
+so both boto3 and aiobotocore are pointed at a ThreadedMotoServer.
+"""
+
+import socket
+import uuid
+
+import pytest
+
+pytest.importorskip('aiobotocore')
+boto3 = pytest.importorskip('boto3')
+moto_server = pytest.importorskip('moto.server')
+
+from webotron import aiotransport  # noqa: E402
+from webotron.aiotransport import AsyncTransport  # noqa: E402
+from webotron.bucket import BucketManager  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def endpoint():
+    """Run a moto S3 server for the module and return its URL."""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = moto_server.ThreadedMotoServer(port=port, verbose=False)
+    server.start()
+    yield 'http://127.0.0.1:{}'.format(port)
+    server.stop()
+
+
+@pytest.fixture
+def session(endpoint, tmp_path, monkeypatch):
+    """Return a boto3 session that talks to the moto server."""
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ENDPOINT_URL_S3', endpoint)
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    return boto3.Session()
+
+
+@pytest.fixture
+def bucket(session):
+    """Create an empty bucket and return its name."""
+    name = 'webotron-{}'.format(uuid.uuid4().hex[:12])
+    session.client('s3').create_bucket(Bucket=name)
+    return name
+
+
+@pytest.fixture
+def site(tmp_path):
+    """Return a directory of a few small files."""
+    root = tmp_path / 'site'
+    (root / 'css').mkdir(parents=True)
+    (root / 'index.html').write_text('<h1>Hello</h1>')
+    (root / 'about.html').write_text('<h1>About</h1>')
+    (root / 'css' / 'site.css').write_text('h1 { color: red; }')
+    return root
+
+
+def sync(session, root, bucket, **options):
+    """Sync root to bucket with a fresh manager, as a new command would."""
+    transport = AsyncTransport(BucketManager(session), max_requests=8,
+                               workers=2)
+    return transport.sync(str(root), bucket, **options)
+
+
+def remote_etags(session, bucket):
+    """Return {key: ETag} of the objects in bucket."""
+    listing = session.client('s3').list_objects_v2(Bucket=bucket)
+    return {item['Key']: item['ETag'] for item in listing.get('Contents', ())}
+
+
+def test_uploads_every_file(session, bucket, site):
+    results = sync(session, site, bucket)
+
+    assert [(r.key, r.status) for r in results] == [
+        ('about.html', 'uploaded'),
+        ('css/site.css', 'uploaded'),
+        ('index.html', 'uploaded'),
+    ]
+    body = session.client('s3').get_object(Bucket=bucket, Key='index.html')
+    assert body['Body'].read() == b'<h1>Hello</h1>'
+    assert body['ContentType'] == 'text/html'
+
+
+def test_second_sync_skips_unchanged_files(session, bucket, site):
+    sync(session, site, bucket)
+    (site / 'index.html').write_text('<h1>Changed</h1>')
+
+    results = sync(session, site, bucket)
+
+    assert {r.key: r.status for r in results} == {
+        'about.html': 'skipped',
+        'css/site.css': 'skipped',
+        'index.html': 'uploaded',
+    }
+
+
+def test_multipart_etag_matches_get_etag(session, bucket, tmp_path):
+    root = tmp_path / 'large'
+    root.mkdir()
+    path = root / 'video.bin'
+    path.write_bytes(bytes(range(256)) * (BucketManager.CHUNK_SIZE // 128 + 3))
+
+    results = sync(session, root, bucket)
+
+    assert results[0].status == 'uploaded'
+    etag = remote_etags(session, bucket)['video.bin']
+    assert etag.endswith('-3"')
+    assert etag == BucketManager(session).get_etag(str(path))
+    assert sync(session, root, bucket)[0].status == 'skipped'
+
+
+def test_delete_removes_keys_not_in_tree(session, bucket, site):
+    session.client('s3').put_object(Bucket=bucket, Key='old.html', Body=b'')
+
+    results = sync(session, site, bucket, delete=True)
+
+    assert ('old.html', 'deleted') in [(r.key, r.status) for r in results]
+    assert sorted(remote_etags(session, bucket)) == [
+        'about.html', 'css/site.css', 'index.html']
+
+
+def test_without_delete_keys_are_kept(session, bucket, site):
+    session.client('s3').put_object(Bucket=bucket, Key='old.html', Body=b'')
+
+    sync(session, site, bucket)
+
+    assert 'old.html' in remote_etags(session, bucket)
+
+
+def test_failing_file_does_not_stop_the_others(
+        session, bucket, site, monkeypatch):
+    read_file = aiotransport.read_file
+
+    def flaky_read(path):
+        if path.endswith('about.html'):
+            raise PermissionError(13, 'Permission denied', path)
+        return read_file(path)
+
+    monkeypatch.setattr(aiotransport, 'read_file', flaky_read)
+    results = sync(session, site, bucket)
+
+    statuses = {r.key: r.status for r in results}
+    assert statuses == {
+        'about.html': 'failed',
+        'css/site.css': 'uploaded',
+        'index.html': 'uploaded',
+    }
+    assert 'Permission denied' in results[0].error
+    assert 'about.html' not in remote_etags(session, bucket)
+
+    monkeypatch.setattr(aiotransport, 'read_file', read_file)
+    statuses = {r.key: r.status for r in sync(session, site, bucket)}
+    assert statuses['about.html'] == 'uploaded'
+    assert statuses['index.html'] == 'skipped'
+
+
+def test_walker_errors_are_raised(session, bucket, site, monkeypatch):
+    sync_files = BucketManager.sync_files
+
+    def broken_walk(self, root, prefix, rules):
+        yield next(sync_files(self, root, prefix, rules))
+        raise RuntimeError('walker broke')
+
+    monkeypatch.setattr(BucketManager, 'sync_files', broken_walk)
+    with pytest.raises(RuntimeError, match='walker broke'):
+        sync(session, site, bucket)
+
+
+def test_client_is_made_for_the_bucket_region(session, site, monkeypatch):
+    name = 'webotron-{}'.format(uuid.uuid4().hex[:12])
+    session.client('s3').create_bucket(
+        Bucket=name,
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    regions = []
+    create_client = AsyncTransport.create_client
+
+    def recording_client(self, region_name):
+        regions.append(region_name)
+        return create_client(self, region_name)
+
+    monkeypatch.setattr(AsyncTransport, 'create_client', recording_client)
+    results = sync(session, site, name)
+
+    assert regions == ['eu-west-1']
+    assert {r.status for r in results} == {'uploaded'}
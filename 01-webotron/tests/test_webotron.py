@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the webotron command line."""
+
+import pytest
+from click.testing import CliRunner
+
+from webotron.webotron import cli
+
+
+@pytest.fixture
+def runner(tmp_path, monkeypatch):
+    """Return a CliRunner with fake credentials and its own HOME."""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    return CliRunner()
+
+
+@pytest.mark.parametrize('option', [['--dedup'], ['--max-bandwidth', '1']])
+def test_async_transport_rejects_unsupported_options(runner, tmp_path,
+                                                     option):
+    result = runner.invoke(cli, ['sync', str(tmp_path), 'bucket',
+                                 '--transport=async'] + option)
+
+    assert result.exit_code == 2
+    assert 'cannot be used with --dedup or --max-bandwidth' in result.output
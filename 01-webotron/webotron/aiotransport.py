@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""Asyncio transport for syncing trees of many small files."""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from botocore.credentials import RefreshableCredentials
+from botocore.exceptions import BotoCoreError, ClientError
+
+from webotron.bucket import FileResult
+from webotron.walker import IgnoreRules
+
+
+def read_file(path):
+    """Return the contents of path."""
+    with open(path, 'rb') as data:
+        return data.read()
+
+
+class AsyncTransport:
+    """Sync a tree for a BucketManager from one asyncio event loop.
+
+    S3 requests are made with aiobotocore, up to max_requests at a time
+    over one shared connection pool. The manifest, ETag cache and
+    hashing are the BucketManager's own; hashing runs on a pool of
+    `workers` threads so it does not block the event loop.
+
+    The aiobotocore client is made for the bucket's region. Credentials
+    that refresh (assume-role, SSO, instance roles) are resolved again by
+    aiobotocore from the same profile, so they keep refreshing during a
+    long sync; fixed keys are passed over as they are.
+
+    Needs the optional aiobotocore package (pip install webotron[async]).
+    """
+
+    def __init__(self, bucket_manager, max_requests=256, workers=4):
+        """Create an AsyncTransport for bucket_manager.
+
+        aiobotocore is only imported here, so it does not slow down
+        starting every other command.
+        """
+        try:
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import AioSession
+        except ImportError:
+            raise RuntimeError(
+                'The async transport needs aiobotocore installed.')
+        session = bucket_manager.session
+        credentials = session.get_credentials()
+        if credentials is None or isinstance(credentials,
+                                             RefreshableCredentials):
+            profile = session.profile_name
+            self.aio_session = AioSession(
+                profile=profile if profile in session.available_profiles
+                else None)
+            self.credentials = {}
+        else:
+            frozen = credentials.get_frozen_credentials()
+            self.aio_session = AioSession()
+            self.credentials = {
+                'aws_access_key_id': frozen.access_key,
+                'aws_secret_access_key': frozen.secret_key,
+                'aws_session_token': frozen.token
+            }
+        self.aio_config = AioConfig(max_pool_connections=max_requests)
+        self.bucket_manager = bucket_manager
+        self.max_requests = max_requests
+        self.workers = workers
+
+    def create_client(self, region_name):
+        """Create an aiobotocore S3 client for a bucket in region_name."""
+        return self.aio_session.create_client(
+            's3',
+            region_name=region_name,
+            config=self.aio_config,
+            **self.credentials
+        )
+
+    def sync(self, pathname, bucket_name, remote_manifest=False, prefix='',
+             excludes=(), includes=(), delete=False, max_deletes=None):
+        """Copy all of pathname to the bucket, like BucketManager.sync."""
+        return asyncio.run(self.run(pathname, bucket_name, remote_manifest,
+                                    prefix, excludes, includes, delete,
+                                    max_deletes))
+
+    async def run(self, pathname, bucket_name, remote_manifest, prefix,
+                  excludes, includes, delete, max_deletes):
+        """Run a sync on the current event loop."""
+        manager = self.bucket_manager
+        loop = asyncio.get_running_loop()
+        s3_bucket = manager.s3.Bucket(bucket_name)
+        prefix = manager.normalize_prefix(prefix)
+        root = str(Path(pathname).expanduser().resolve())
+        rules = IgnoreRules.for_root(root, excludes, includes)
+        results = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            await loop.run_in_executor(
+                executor, manager.load_sync_manifest, s3_bucket, prefix,
+                self.workers, remote_manifest)
+            region_name = await loop.run_in_executor(
+                executor, manager.get_region_name, s3_bucket)
+
+            async with self.create_client(region_name) as client:
+                files = asyncio.Queue(self.max_requests)
+                slots = asyncio.Semaphore(self.max_requests)
+                tasks = set()
+
+                feed_errors = []
+
+                def feed():
+                    try:
+                        for item in manager.sync_files(root, prefix, rules):
+                            asyncio.run_coroutine_threadsafe(
+                                files.put(item), loop).result()
+                    except Exception as exception:
+                        feed_errors.append(exception)
+                    finally:
+                        asyncio.run_coroutine_threadsafe(
+                            files.put(None), loop).result()
+
+                async def handle(item):
+                    try:
+                        results.append(await self.sync_file(
+                            client, executor, bucket_name, *item))
+                    finally:
+                        slots.release()
+
+                walker = threading.Thread(target=feed, daemon=True)
+                walker.start()
+                while True:
+                    item = await files.get()
+                    if item is None:
+                        break
+                    await slots.acquire()
+                    task = loop.create_task(handle(item))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await asyncio.gather(*tasks)
+                walker.join()
+                if feed_errors:
+                    raise feed_errors[0]
+                results.extend(manager.walk_errors)
+
+            if delete:
+                doomed, refused = manager.find_deletes(
+                    prefix, {result.key for result in results}, rules,
+                    max_deletes)
+                results.extend(refused)
+                results.extend(await loop.run_in_executor(
+                    executor, manager.delete_keys, s3_bucket, doomed,
+                    self.workers))
+
+        manager.evict_etags(root)
+
+        manager.update_remote_manifest(s3_bucket, results, remote_manifest)
+
+        return sorted(results)
+
+    async def sync_file(self, client, executor, bucket_name, path, key,
+                        stat):
+        """Hash path and upload it to key if the manifest differs."""
+        manager = self.bucket_manager
+        loop = asyncio.get_running_loop()
+        try:
+            path, stat = await loop.run_in_executor(
+                executor, manager.precompress_file, path, key, stat)
+            etag = await loop.run_in_executor(
+                executor, manager.check_file, path, key, stat)
+            if etag is None:
+                return FileResult(key, 'skipped', None)
+            if stat.st_size < manager.CHUNK_SIZE:
+                body = await loop.run_in_executor(executor, read_file, path)
+                await client.put_object(Bucket=bucket_name, Key=key,
+                                        Body=body, **manager.upload_args(key))
+            else:
+                await self.put_multipart(client, executor, bucket_name,
+                                         path, key)
+        except (BotoCoreError, ClientError, OSError) as exception:
+            return FileResult(key, 'failed', str(exception))
+        manager.manifest.add(key, etag, stat.st_size)
+        return FileResult(key, 'uploaded', None)
+
+    async def put_multipart(self, client, executor, bucket_name, path, key):
+        """Upload path in CHUNK_SIZE parts, so its ETag matches get_etag."""
+        loop = asyncio.get_running_loop()
+        upload = await client.create_multipart_upload(
+            Bucket=bucket_name, Key=key,
+            **self.bucket_manager.upload_args(key))
+        parts = []
+        try:
+            with open(path, 'rb') as data:
+                while True:
+                    chunk = await loop.run_in_executor(
+                        executor, data.read, self.bucket_manager.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    part = await client.upload_part(
+                        Bucket=bucket_name, Key=key,
+                        UploadId=upload['UploadId'],
+                        PartNumber=len(parts) + 1, Body=chunk)
+                    parts.append({'ETag': part['ETag'],
+                                  'PartNumber': len(parts) + 1})
+            await client.complete_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload['UploadId'],
+                MultipartUpload={'Parts': parts})
+        except BaseException:
+            await client.abort_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload['UploadId'])
+            raise
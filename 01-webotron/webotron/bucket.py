@@ -3,39 +3,112 @@
 
 from pathlib import Path
 import mimetypes
-from functools import reduce
+import heapq
+import mmap
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from operator import itemgetter
 
-import boto3
-from botocore.exceptions import ClientError
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
 
 from hashlib import md5
-import webotron import util
+from webotron import util
+from webotron.clients import ClientRegistry
+from webotron.journal import SyncJournal
+from webotron.manifest import (
+    MANIFEST_KEY, Manifest, read_manifest, write_manifest)
+from webotron.pipeline import Pipeline
+from webotron.plan import PlannedUpload, SyncPlan
+from webotron.policy import IMMUTABLE
+from webotron.throttle import THROTTLE_CODES, AdaptiveLimiter, is_throttle
+from webotron.walker import IgnoreRules, walk
+from webotron.watch import watch_tree
+
+FileResult = namedtuple('FileResult', ['key', 'status', 'error'])
 
 
 class BucketManager:
     """Manage and S3 Bucket."""
 
     CHUNK_SIZE = 8388608
+    SHARD_BUFFER = 64
+    DELETE_BATCH = 1000
+    PARALLEL_HASH_PARTS = 8
+    DEDUP_MIN_SIZE = 65536
+    THROTTLE_RETRIES = 3
+
+    def __init__(self, session, region_name=None, clients=None):
+        """Create BucketManager object, in region_name if given.
 
-    def __init__(self, session):
-        """Create BucketManager object."""
+        The S3 resource comes from clients, a ClientRegistry, on first
+        use.
+        """
         self.session = session
-        self.s3 = self.session.resource('s3')
-        self.transfer_config = boto3.s3.transfer.TransferConfig(
+        self.region_name = region_name
+        self.clients = clients or ClientRegistry(session)
+        self.hooked = False
+        self.regions = {}
+        self.transfer_config = TransferConfig(
             multipart_chunksize=self.CHUNK_SIZE,
             multipart_threshold=self.CHUNK_SIZE
         )
-        self.manifest = {}
+        self.manifest = Manifest()
+        self.etag_cache = None
+        self.stage_stats = []
+        self.hash_threads = os.cpu_count() or 1
+        self.hash_executor = None
+        self.dedup = False
+        self.dedup_lock = threading.Lock()
+        self.dedup_uploads = {}
+        self.bytes_saved = 0
+        self.metadata_rules = None
+        self.fingerprinter = None
+        self.immutable_keys = set()
+        self.precompressor = None
+        self.content_encodings = {}
+        self.limiter = AdaptiveLimiter(1)
+        self.bandwidth = None
+        self.journal_dir = None
+        self.journal = None
+        self.walk_errors = []
+
+    @property
+    def stats(self):
+        """Get the Stats the phases of a sync are timed in."""
+        return self.clients.stats
+
+    @property
+    def s3(self):
+        """Get the S3 resource, hooking its retries up to limiter."""
+        s3 = self.clients.resource('s3', self.region_name)
+        if not self.hooked:
+            s3.meta.client.meta.events.register_first(
+                'needs-retry.s3', self.check_retry,
+                unique_id='webotron-throttle-{}'.format(id(self)))
+            self.hooked = True
+        return s3
 
     def get_bucket(self, bucket_name):
         """Get the bucket object using it's name."""
         return self.s3.Bucket(bucket_name)
 
     def get_region_name(self, bucket):
-        """Get the bucket's region name."""
-        bucket_location = self.s3.meta.client.get_bucket_location(
-            Bucket=bucket.name)
-        return bucket_location["LocationConstraint"] or 'us-east-1'
+        """Get the bucket's region name, looking it up only once."""
+        if bucket.name not in self.regions:
+            bucket_location = self.s3.meta.client.get_bucket_location(
+                Bucket=bucket.name)
+            self.regions[bucket.name] = \
+                bucket_location["LocationConstraint"] or 'us-east-1'
+        return self.regions[bucket.name]
 
     def get_bucket_url(self, bucket):
         """Get the sebsite URL for this bucket."""
@@ -47,9 +120,75 @@ class BucketManager:
         """Return all buckets."""
         return self.s3.buckets.all()
 
-    def all_objects(self, bucket):
+    def all_objects(self, bucket, prefix='', workers=1):
         """List objects in an s3 bucket."""
-        return self.s3.Bucket(bucket).objects.all()
+        for obj in self.list_objects(bucket, prefix, workers):
+            yield self.s3.ObjectSummary(bucket, obj['Key'])
+
+    def list_objects(self, bucket_name, prefix='', workers=1):
+        """Yield the object dicts in bucket_name under prefix, in key order.
+
+        With more than one worker, the top level prefixes under prefix are
+        found with a delimited listing and then listed concurrently. Each
+        shard buffers at most SHARD_BUFFER pages ahead of the shard being
+        yielded.
+        """
+        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+        if workers < 2:
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                yield from page.get('Contents', [])
+            return
+
+        top, shards = [], []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix,
+                                       Delimiter='/'):
+            top.extend(page.get('Contents', []))
+            shards.extend(common['Prefix']
+                          for common in page.get('CommonPrefixes', []))
+
+        stop = threading.Event()
+
+        def put(pages, item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def list_shard(shard, pages):
+            try:
+                for page in paginator.paginate(Bucket=bucket_name,
+                                               Prefix=shard):
+                    put(pages, page.get('Contents', []))
+                put(pages, None)
+            except Exception as exception:
+                put(pages, exception)
+
+        def read_shard(pages):
+            while not stop.is_set():
+                try:
+                    contents = pages.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if contents is None:
+                    return
+                if isinstance(contents, Exception):
+                    raise contents
+                yield from contents
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            streams = []
+            for shard in shards:
+                pages = queue.Queue(maxsize=self.SHARD_BUFFER)
+                executor.submit(list_shard, shard, pages)
+                streams.append(read_shard(pages))
+            yield from heapq.merge(top, chain.from_iterable(streams),
+                                   key=itemgetter('Key'))
+        finally:
+            stop.set()
+            executor.shutdown(cancel_futures=True)
 
     def init_bucket(self, bucket_name):
         """Create a bucket if doesn't aready exist."""
@@ -110,12 +249,105 @@ class BucketManager:
             }
         )
 
-    def load_manifest(self, bucket):
+    def load_manifest(self, bucket, prefix='', workers=1):
         """Load the manifest information."""
-        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket.name):
-            for obj in page.get('Contents', []):
-                self.manifest[obj['Key']] = obj['ETag']
+        with self.stats.phase('load_manifest'):
+            for obj in self.list_objects(bucket.name, prefix, workers):
+                if obj['Key'] == MANIFEST_KEY:
+                    continue
+                self.manifest.add(obj['Key'], obj['ETag'], obj['Size'])
+            self.manifest.freeze()
+
+    def load_remote_manifest(self, bucket):
+        """Load the manifest from the manifest object in bucket.
+
+        Return False, leaving the manifest empty, if there is no manifest
+        object or a spot check against one page of the listing disagrees
+        with it.
+        """
+        with self.stats.phase('load_remote_manifest'):
+            try:
+                body = bucket.Object(MANIFEST_KEY).get()['Body']
+            except ClientError as exception:
+                if exception.response['Error']['Code'] in ('NoSuchKey',
+                                                           '404'):
+                    return False
+                raise exception
+
+            if (not self.add_manifest_entries(read_manifest(body)) or
+                    not self.spot_check(bucket)):
+                self.reset_manifest()
+                return False
+            return True
+
+    def add_manifest_entries(self, entries):
+        """Add (key, etag, size) entries to the manifest and freeze it.
+
+        Return False, leaving the manifest empty, if entries raises
+        ValueError part way through.
+        """
+        try:
+            for key, etag, size in entries:
+                self.manifest.add(key, etag, size)
+        except ValueError:
+            self.reset_manifest()
+            return False
+        self.manifest.freeze()
+        return True
+
+    def reset_manifest(self):
+        """Replace the manifest with an empty one."""
+        self.manifest.close()
+        self.manifest = Manifest(spill=self.manifest.spill)
+
+    def spot_check(self, bucket):
+        """Compare a random page of the bucket listing with the manifest."""
+        start = random.randrange(self.manifest.count + 1)
+        params = {'Bucket': bucket.name}
+        start_after = None
+        if start:
+            start_after = self.manifest.key_at(start - 1).decode('utf-8')
+            params['StartAfter'] = start_after
+        page = self.s3.meta.client.list_objects_v2(**params)
+
+        listed = [(obj['Key'], obj['ETag'], obj['Size'])
+                  for obj in page.get('Contents', [])
+                  if obj['Key'] != MANIFEST_KEY]
+        expected = self.manifest.items(start_after)
+        if page.get('IsTruncated'):
+            return listed == list(islice(expected, len(listed)))
+        return listed == list(islice(expected, len(listed) + 1))
+
+    def save_remote_manifest(self, bucket):
+        """Write the current manifest to the manifest object in bucket.
+
+        The body is streamed out of the manifest into a temporary file.
+        """
+        with tempfile.TemporaryFile() as body:
+            write_manifest(self.manifest.items(), body)
+            body.seek(0)
+            bucket.put_object(
+                Key=MANIFEST_KEY,
+                Body=body,
+                ContentType='application/gzip'
+            )
+
+    def update_remote_manifest(self, bucket, results, remote_manifest):
+        """Keep the manifest object in bucket true after a sync.
+
+        With remote_manifest and no failures, the manifest object is
+        rewritten. Otherwise, if the sync may have changed the bucket, it
+        is deleted, so no later --remote-manifest run trusts it; failing
+        to delete it adds a failed FileResult to results.
+        """
+        if remote_manifest and all(r.status != 'failed' for r in results):
+            self.save_remote_manifest(bucket)
+        elif any(r.status != 'skipped' for r in results):
+            try:
+                bucket.Object(MANIFEST_KEY).delete()
+            except (BotoCoreError, ClientError) as exception:
+                results.append(FileResult(MANIFEST_KEY, 'failed',
+                                          str(exception)))
 
     @staticmethod
     def hash_data(data):
@@ -124,60 +356,850 @@ class BucketManager:
         hash.update(data)
         return hash
 
-    def get_etag(self, path):
-        """Generate etag for file."""
-        hashes = []
+    def get_etag(self, path, stat=None):
+        """Get etag for file, from the etag cache if it is still valid.
+
+        stat, if given, is used instead of stat'ing path again.
+        """
+        with self.stats.phase('get_etag'):
+            if self.etag_cache is None:
+                return self.compute_etag(path)
+
+            stat = stat or os.stat(path)
+            etag = self.etag_cache.lookup(path, stat, self.CHUNK_SIZE)
+            if etag is None:
+                etag = self.compute_etag(path)
+                self.etag_cache.store(path, stat, self.CHUNK_SIZE, etag)
+            return etag
+
+    def compute_etag(self, path):
+        """Generate etag for file, as S3 computes it for our uploads.
 
-        with open(path, 'rb') as f:
+        Files of CHUNK_SIZE or more are uploaded in CHUNK_SIZE parts, so
+        their etag is the md5 of the parts' md5 digests. Parts are read
+        into one reused buffer, or, for files of PARALLEL_HASH_PARTS parts
+        or more, hashed straight from an mmap on hash_threads threads.
+        """
+        with self.stats.phase('compute_etag'), open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.CHUNK_SIZE:
+                return '"{}"'.format(self.hash_data(f.read()).hexdigest())
+
+            parts = -(-size // self.CHUNK_SIZE)
+            if parts >= self.PARALLEL_HASH_PARTS and self.hash_threads > 1:
+                digests = self.hash_parts_mmap(f, size)
+            else:
+                digests = self.hash_parts(f)
+        return '"{}-{}"'.format(self.hash_data(digests).hexdigest(), parts)
+
+    def hash_parts(self, f):
+        """Return the joined md5 digests of f's parts."""
+        buffer = bytearray(self.CHUNK_SIZE)
+        digests = bytearray()
+        with memoryview(buffer) as view:
             while True:
-                data = f.read(self.CHUNK_SIZE)
-                if not data:
+                count = f.readinto(buffer)
+                if not count:
                     break
-                hashes.append(self.hash_data(data))
-        if not hashes:
-            return
-        elif len(hashes) == 1:
-            return '"{}"'.format(hashes[0].hexdigest())
-        else:
-            digests = (h.digest() for h in hashes)
-            hash = self.hash_data(reduce(lambda x, y: x + y, digests))
-            return '"{}-{}"'.format(hash.hexdigest(), len(hashes))
+                with view[:count] as data:
+                    digests += self.hash_data(data).digest()
+        return bytes(digests)
+
+    def hash_parts_mmap(self, f, size):
+        """Return the joined md5 digests of f's parts, hashed in parallel.
+
+        md5 releases the GIL while hashing, so the parts are spread over
+        a thread pool and hashed from zero-copy slices of an mmap.
+        """
+        if self.hash_executor is None:
+            self.hash_executor = ThreadPoolExecutor(
+                max_workers=self.hash_threads)
+
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                def hash_part(start):
+                    with view[start:start + self.CHUNK_SIZE] as data:
+                        return self.hash_data(data).digest()
+
+                return b''.join(self.hash_executor.map(
+                    hash_part, range(0, size, self.CHUNK_SIZE)))
 
     def upload_file(self, bucket, path, key):
-        """Upload path to S3_bucket at key."""
-        content_type = mimetypes.guess_type(key)[0] or 'text/plain'
+        """Upload path to S3_bucket at key.
+
+        Return 'skipped' if the manifest already has this etag,
+        otherwise 'uploaded'.
+        """
         etag = self.get_etag(path)
         if self.manifest.get(key, '') == etag:
+            return 'skipped'
+        return self.put_file(bucket, path, key, etag)
+
+    def upload_args(self, key):
+        """Return the extra arguments to upload key with.
+
+        metadata_rules, if set, add to (or override) the Content-Type,
+        precompressed keys get their Content-Encoding (which no rule can
+        override, as it describes the bytes uploaded), and fingerprinted
+        assets are marked as immutable.
+        """
+        args = {
+            'ContentType': mimetypes.guess_type(key)[0] or 'text/plain'
+        }
+        if self.metadata_rules is not None:
+            args.update(self.metadata_rules.args_for(key))
+        if key in self.content_encodings:
+            args['ContentEncoding'] = self.content_encodings[key]
+        if key in self.immutable_keys:
+            args['CacheControl'] = IMMUTABLE
+        return args
+
+    def put_file(self, bucket, path, key, etag):
+        """Upload path, whose etag is already known, to S3_bucket at key.
+
+        With dedup set, a file whose content the bucket already holds is
+        copied server side from that object instead, and 'copied' is
+        returned. Of several files with the same content in one sync,
+        the first is uploaded and the rest copy it.
+        """
+        size = os.path.getsize(path)
+        if self.dedup and size >= self.DEDUP_MIN_SIZE:
+            try:
+                source = self.dedup_source(etag)
+                if source is not None and self.copy_object(
+                        bucket, source, key, etag):
+                    self.manifest.add(key, etag, size)
+                    with self.dedup_lock:
+                        self.bytes_saved += size
+                    return 'copied'
+                return self.put_file_data(bucket, path, key, etag, size)
+            finally:
+                self.dedup_done(etag)
+        return self.put_file_data(bucket, path, key, etag, size)
+
+    def put_file_data(self, bucket, path, key, etag, size):
+        """Upload the bytes of path to S3_bucket at key.
+
+        The upload waits for a slot from limiter, and one that still
+        fails because S3 is throttling is tried again (up to
+        THROTTLE_RETRIES times) once the limit has come down. With
+        bandwidth set, the upload is held to its rate.
+
+        With a journal, large files are uploaded by put_multipart so an
+        interrupted upload can be resumed.
+        """
+        callback = self.bandwidth.consume if self.bandwidth else None
+        for attempt in range(self.THROTTLE_RETRIES + 1):
+            try:
+                with self.limiter.slot(), self.stats.phase('upload'):
+                    if self.journal is not None and size >= self.CHUNK_SIZE:
+                        self.put_multipart(bucket, path, key, etag, size,
+                                           callback)
+                    else:
+                        bucket.upload_file(
+                            path,
+                            key,
+                            ExtraArgs=self.upload_args(key),
+                            Callback=callback,
+                            Config=self.transfer_config
+                        )
+            except (ClientError, S3UploadFailedError) as exception:
+                if (attempt == self.THROTTLE_RETRIES or
+                        not self.is_throttle_error(exception)):
+                    raise
+                time.sleep(random.uniform(0, 2 ** attempt))
+            else:
+                break
+        self.limiter.success()
+        self.manifest.add(key, etag, size)
+        return 'uploaded'
+
+    def put_multipart(self, bucket, path, key, etag, size, callback=None):
+        """Upload path in CHUNK_SIZE parts, journaling each part.
+
+        If the journal has an open upload of the same content to key,
+        only the parts S3 does not already have are uploaded. An upload
+        that fails is left open for sync --resume.
+        """
+        client = self.s3.meta.client
+        resumed = self.journal.resumable(key, etag, size)
+        parts = {}
+        if resumed is not None:
+            upload_id, journaled = resumed
+            try:
+                listed = {
+                    part['PartNumber']: part['ETag']
+                    for page in client.get_paginator('list_parts').paginate(
+                        Bucket=bucket.name, Key=key, UploadId=upload_id)
+                    for part in page.get('Parts', [])}
+            except ClientError:
+                self.journal.record('end', upload_id=upload_id)
+                resumed = None
+            else:
+                parts = {number: part_etag
+                         for number, part_etag in journaled.items()
+                         if listed.get(number) == part_etag}
+        if resumed is None:
+            stat = os.stat(path)
+            upload_id = client.create_multipart_upload(
+                Bucket=bucket.name, Key=key,
+                **self.upload_args(key))['UploadId']
+            self.journal.record('create', upload_id=upload_id, key=key,
+                                etag=etag, size=size,
+                                mtime_ns=stat.st_mtime_ns)
+
+        def upload_part(number):
+            with open(path, 'rb') as data:
+                data.seek((number - 1) * self.CHUNK_SIZE)
+                chunk = data.read(self.CHUNK_SIZE)
+            if callback is not None:
+                callback(len(chunk))
+            part_etag = client.upload_part(
+                Bucket=bucket.name, Key=key, UploadId=upload_id,
+                PartNumber=number, Body=chunk)['ETag']
+            self.journal.record('part', upload_id=upload_id, part=number,
+                                etag=part_etag)
+            return number, part_etag
+
+        missing = [number
+                   for number in range(1, -(-size // self.CHUNK_SIZE) + 1)
+                   if number not in parts]
+        with ThreadPoolExecutor(
+                max_workers=self.transfer_config.max_concurrency
+        ) as executor:
+            parts.update(executor.map(upload_part, missing))
+        client.complete_multipart_upload(
+            Bucket=bucket.name, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': number, 'ETag': parts[number]}
+                for number in sorted(parts)]})
+        self.journal.record('end', upload_id=upload_id)
+
+    def start_journal(self, bucket, root, prefix, workers, remote_manifest,
+                      resume):
+        """Open the journal for a sync and load the manifest it compares.
+
+        With resume, an earlier sync's journal is replayed and the
+        manifest comes from its snapshot instead of the bucket (and is
+        snapshotted if there was none). Without it, multipart uploads an
+        earlier sync left open are aborted and its journal is thrown
+        away.
+        """
+        self.journal = None
+        loaded = False
+        if self.journal_dir is not None:
+            journal = SyncJournal.for_sync(self.journal_dir, root,
+                                           bucket.name, prefix)
+            journal.replay()
+            if resume:
+                loaded = self.add_manifest_entries(journal.read_snapshot())
+            else:
+                self.abort_uploads(bucket, journal)
+                journal.discard()
+                journal = SyncJournal(journal.path)
+            journal.open()
+            self.journal = journal
+
+        if not loaded:
+            self.load_sync_manifest(bucket, prefix, workers, remote_manifest)
+            if resume and self.journal is not None:
+                self.journal.save_snapshot(self.manifest.items())
+        if self.journal is not None:
+            for key, (etag, size, _) in self.journal.done.items():
+                self.manifest.add(key, etag, size)
+
+    def finish_journal(self, bucket, results):
+        """Close the journal at the end of a sync.
+
+        If everything synced, left over multipart uploads are aborted and
+        the journal is deleted; otherwise it is kept for --resume, with a
+        snapshot of the manifest.
+        """
+        if self.journal is None:
             return
+        if all(result.status != 'failed' for result in results):
+            self.abort_uploads(bucket, self.journal)
+            self.journal.discard()
         else:
-            return bucket.upload_file(
-                path,
-                key,
-                ExtraArgs={
-                    'ContentType': content_type
-                },
-                Config=self.transfer_config
-            )
+            self.journal.save_snapshot(self.manifest.items())
+            self.journal.close()
+        self.journal = None
+
+    def abort_uploads(self, bucket, journal):
+        """Abort the multipart uploads journal has left open."""
+        for upload_id, key in journal.open_uploads():
+            try:
+                self.s3.meta.client.abort_multipart_upload(
+                    Bucket=bucket.name, Key=key, UploadId=upload_id)
+            except ClientError as exception:
+                if exception.response['Error']['Code'] != 'NoSuchUpload':
+                    raise exception
+            journal.apply({'op': 'end', 'upload_id': upload_id})
+
+    def check_retry(self, response=None, **kwargs):
+        """Tell limiter about each request S3 throttled.
+
+        Registered for botocore's needs-retry event, which sees every
+        attempt, so throttles that botocore retries itself are counted.
+        """
+        if is_throttle(response):
+            self.limiter.throttle()
+
+    @staticmethod
+    def is_throttle_error(exception):
+        """Return True if an upload failed because S3 was throttling.
+
+        boto3 wraps the ClientError of a failed upload_file in an
+        S3UploadFailedError, so the ClientError is looked for along the
+        exception's chain, and its error code or HTTP status is checked.
+        """
+        while exception is not None:
+            if isinstance(exception, ClientError):
+                return (exception.response.get('Error', {}).get('Code') in
+                        THROTTLE_CODES or
+                        exception.response.get('ResponseMetadata', {}).get(
+                            'HTTPStatusCode') == 503)
+            exception = exception.__cause__ or exception.__context__
+        return False
+
+    def dedup_source(self, etag):
+        """Return a key already holding etag, or None to upload it.
+
+        If another thread of this sync is uploading the same content,
+        wait for it to finish and use its key.
+        """
+        with self.dedup_lock:
+            source = self.manifest.find_etag(etag)
+            if source is not None:
+                return source
+            uploading = self.dedup_uploads.get(etag)
+            if uploading is None:
+                self.dedup_uploads[etag] = threading.Event()
+                return None
+        uploading.wait()
+        with self.dedup_lock:
+            return self.manifest.find_etag(etag)
+
+    def dedup_done(self, etag):
+        """Wake any threads waiting on an upload of etag."""
+        with self.dedup_lock:
+            uploading = self.dedup_uploads.pop(etag, None)
+        if uploading is not None:
+            uploading.set()
+
+    def copy_object(self, bucket, source, key, etag):
+        """Copy source to key server side, if source still has etag.
+
+        Large objects are copied in CHUNK_SIZE parts, so the copy's etag
+        matches get_etag. Return False if the copy could not be made.
+        """
+        extra_args = self.upload_args(key)
+        extra_args['MetadataDirective'] = 'REPLACE'
+        extra_args['CopySourceIfMatch'] = etag
+        try:
+            with self.stats.phase('copy'):
+                self.s3.meta.client.copy(
+                    {'Bucket': bucket.name, 'Key': source},
+                    bucket.name,
+                    key,
+                    ExtraArgs=extra_args,
+                    Config=self.transfer_config
+                )
+        except ClientError:
+            return False
+        return True
+
+    def delete_keys(self, bucket, keys, workers=1):
+        """Delete keys from bucket with batched DeleteObjects calls.
 
-    def sync(self, pathname, bucket_name):
-        """Copy all of the pathname to the bucket."""
+        Batches of up to DELETE_BATCH keys are sent by `workers` threads.
+        Return a FileResult for each key, 'deleted' or 'failed'.
+        """
+        client = self.s3.meta.client
+
+        def delete_batch(batch):
+            try:
+                with self.stats.phase('delete'):
+                    response = client.delete_objects(
+                        Bucket=bucket.name,
+                        Delete={
+                            'Objects': [{'Key': key} for key in batch],
+                            'Quiet': True
+                        }
+                    )
+            except (BotoCoreError, ClientError) as exception:
+                return [FileResult(key, 'failed', str(exception))
+                        for key in batch]
+
+            errors = {error['Key']: '{}: {}'.format(error['Code'],
+                                                    error['Message'])
+                      for error in response.get('Errors', [])}
+            results = []
+            for key in batch:
+                if key in errors:
+                    results.append(FileResult(key, 'failed', errors[key]))
+                else:
+                    self.manifest.remove(key)
+                    results.append(FileResult(key, 'deleted', None))
+            return results
+
+        batches = [keys[start:start + self.DELETE_BATCH]
+                   for start in range(0, len(keys), self.DELETE_BATCH)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(chain.from_iterable(
+                executor.map(delete_batch, batches)))
+
+    def load_sync_manifest(self, bucket, prefix, workers, remote_manifest):
+        """Load the manifest sync compares against."""
+        if remote_manifest:
+            # The manifest object covers the whole bucket, so it must
+            # never be rebuilt from a listing of just one prefix.
+            if not self.load_remote_manifest(bucket):
+                self.load_manifest(bucket, workers=workers)
+        else:
+            self.load_manifest(bucket, prefix, workers)
+
+    def precompress_file(self, path, key, stat):
+        """Return (path, stat) of the file to upload to key.
+
+        With a precompressor set, a file worth compressing is swapped for
+        its compressed copy, so that copy's ETag is what is compared with
+        the manifest and uploaded. Otherwise any Content-Encoding left for
+        key by an earlier compressed version (as in --watch) is dropped.
+        """
+        if self.precompressor is None or not self.precompressor.eligible(key):
+            self.content_encodings.pop(key, None)
+            return path, stat
+        etag = self.get_etag(path, stat)
+        with self.stats.phase('compress'):
+            compressed = self.precompressor.compress(path, etag)
+        if compressed is None:
+            self.content_encodings.pop(key, None)
+            return path, stat
+        self.content_encodings[key] = self.precompressor.encoding
+        return compressed, os.stat(compressed)
+
+    def check_file(self, path, key, stat=None):
+        """Return the etag of path if key needs uploading, else None."""
+        etag = self.get_etag(path, stat)
+        if self.manifest.get(key, '') == etag:
+            return None
+        return etag
+
+    def find_deletes(self, prefix, local_keys, rules, max_deletes=None):
+        """Find the keys sync --delete would remove.
+
+        Return (keys to delete, FileResults for keys refused because
+        there are more than max_deletes of them).
+        """
+        doomed = [key for key in self.manifest
+                  if key.startswith(prefix) and key not in local_keys and
+                  not rules.ignored_file(key[len(prefix):]) and
+                  not self.unreadable(key)]
+        return self.limit_deletes(doomed, max_deletes)
+
+    def unreadable(self, key):
+        """Return True if key's file, or a directory above it, was unreadable.
+
+        Such keys are never deleted: their files may well still be there.
+        """
+        for error in self.walk_errors:
+            under = error.key if error.key.endswith('/') or not error.key \
+                else error.key + '/'
+            if key == error.key or key.startswith(under):
+                return True
+        return False
+
+    @staticmethod
+    def limit_deletes(doomed, max_deletes=None):
+        """Return (doomed, []), or ([], refusals) if over max_deletes."""
+        if max_deletes is not None and len(doomed) > max_deletes:
+            error = 'not deleted: {} deletions is over the limit of ' \
+                    '{}'.format(len(doomed), max_deletes)
+            return [], [FileResult(key, 'failed', error) for key in doomed]
+        return doomed, []
+
+    def sync_files(self, root, prefix, rules):
+        """Yield (path, key, stat) for each file to sync from root.
+
+        With a fingerprinter set, assets get their fingerprinted keys and
+        rewritten HTML and CSS come from its stage directory.
+
+        Files and directories that cannot be read are left in walk_errors
+        as failed FileResults.
+        """
+        self.walk_errors = []
+
+        def walk_error(relpath, exception):
+            self.walk_errors.append(
+                FileResult(prefix + relpath, 'failed', str(exception)))
+
+        files = self.stats.timed('walk', walk(root, rules,
+                                              onerror=walk_error))
+        if self.fingerprinter is not None:
+            self.fingerprinter.prepare(root, rules, self.get_etag)
+            self.immutable_keys.update(
+                prefix + relpath
+                for relpath in self.fingerprinter.renamed.values())
+            files = self.fingerprinter.transform(files)
+        for path, relpath, stat in files:
+            yield path, prefix + relpath, stat
+
+    def evict_etags(self, root):
+        """Evict ETag cache rows for files this sync no longer saw.
+
+        Compressed copies are shared by every site, so only the rows of
+        the copies prune deletes are dropped for them.
+        """
+        if self.etag_cache is not None:
+            self.etag_cache.evict(root)
+            if self.fingerprinter is not None:
+                self.etag_cache.evict(self.fingerprinter.stage_dir)
+        if self.precompressor is not None:
+            pruned = self.precompressor.prune()
+            if self.etag_cache is not None:
+                self.etag_cache.forget(pruned)
+
+    def commit_etags(self):
+        """Write the ETag cache's pending rows to disk."""
+        if self.etag_cache is not None:
+            self.etag_cache.commit()
+
+    def upload_files(self, bucket, files, workers=1, name='walk'):
+        """Upload the (path, key, stat) items of files that have changed.
+
+        Files are compressed (with a precompressor set), hashed and
+        uploaded by a Pipeline of `workers` threads a stage, named name
+        after the source. Return a FileResult for each file.
+        """
+        results = []
+
+        def compress_file(item):
+            path, key, stat = item
+            try:
+                path, stat = self.precompress_file(path, key, stat)
+            except OSError as exception:
+                results.append(FileResult(key, 'failed', str(exception)))
+                return None
+            return path, key, stat
+
+        def record_done(key, etag, stat):
+            if self.journal is not None:
+                self.journal.record('done', key=key, etag=etag,
+                                    size=stat.st_size,
+                                    mtime_ns=stat.st_mtime_ns)
+
+        def hash_file(item):
+            path, key, stat = item
+            if (self.journal is not None and
+                    self.journal.completed(key, stat) is not None):
+                results.append(FileResult(key, 'skipped', None))
+                return None
+            try:
+                etag = self.check_file(path, key, stat)
+            except OSError as exception:
+                results.append(FileResult(key, 'failed', str(exception)))
+                return None
+            if etag is None:
+                record_done(key, self.manifest.get(key), stat)
+                results.append(FileResult(key, 'skipped', None))
+                return None
+            return path, key, etag, stat
+
+        def put_file(item):
+            path, key, etag, stat = item
+            try:
+                status = self.put_file(bucket, path, key, etag)
+            except (BotoCoreError, ClientError, S3UploadFailedError,
+                    OSError) as exception:
+                return FileResult(key, 'failed', str(exception))
+            record_done(key, etag, stat)
+            return FileResult(key, status, None)
+
+        pipeline = Pipeline(queue_size=workers * 4)
+        if self.precompressor is not None:
+            pipeline.add_stage('compress', compress_file, workers)
+        pipeline.add_stage('hash', hash_file, workers)
+        pipeline.add_stage('upload', put_file, workers)
+        results.extend(pipeline.run(files, name=name))
+        self.stage_stats = pipeline.stats
+        return results
+
+    @staticmethod
+    def normalize_prefix(prefix):
+        """Return prefix as sync uses it: empty, or ending in one '/'."""
+        return prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def sync(self, pathname, bucket_name, workers=1, remote_manifest=False,
+             prefix='', excludes=(), includes=(), delete=False,
+             max_deletes=None, resume=False):
+        """Copy all of the pathname to the bucket.
+
+        The tree is walked, hashed and uploaded by a Pipeline: the walk
+        runs on one thread while `workers` threads hash files and another
+        `workers` threads upload them (with a precompressor set, another
+        `workers` threads compress them first). Stage timings are left in
+        stage_stats.
+
+        Uploads share an AdaptiveLimiter of up to `workers` requests,
+        which backs off while S3 is throttling and is left in limiter.
+
+        Return a list of FileResult, one per local file, sorted by key.
+        A file that fails is reported in its FileResult and does not
+        stop the rest of the sync.
+
+        With remote_manifest, the manifest is read from (and afterwards
+        written back to) a manifest object in the bucket instead of
+        listing the whole bucket. Any other sync that changes the bucket
+        deletes the manifest object, so it is never trusted once stale.
+
+        With prefix, files are copied to keys under prefix and only that
+        part of the bucket is listed.
+
+        Files matched by the default ignore rules, the tree's
+        .webotronignore or excludes (and not re-included by includes)
+        are left out; see IgnoreRules.
+
+        With delete, keys under prefix that have no local file (and are
+        not ignored) are deleted after the uploads. If there are more
+        than max_deletes of them nothing is deleted and each is reported
+        as failed.
+
+        With journal_dir set, progress is journaled (see SyncJournal),
+        and with resume a sync that was interrupted carries on: files it
+        finished are not hashed again, the bucket is not listed again and
+        multipart uploads continue from their last part.
+        """
+        s3_bucket = self.s3.Bucket(bucket_name)
+        prefix = self.normalize_prefix(prefix)
+        self.limiter = AdaptiveLimiter(workers)
+        root = str(Path(pathname).expanduser().resolve())
+        self.start_journal(s3_bucket, root, prefix, workers, remote_manifest,
+                           resume)
+
+        rules = IgnoreRules.for_root(root, excludes, includes)
+        results = self.upload_files(
+            s3_bucket, self.sync_files(root, prefix, rules), workers)
+        results.extend(self.walk_errors)
+
+        if delete:
+            doomed, refused = self.find_deletes(
+                prefix, {result.key for result in results}, rules,
+                max_deletes)
+            results.extend(refused)
+            results.extend(self.delete_keys(s3_bucket, doomed, workers))
+
+        self.evict_etags(root)
+
+        self.update_remote_manifest(s3_bucket, results, remote_manifest)
+        self.finish_journal(s3_bucket, results)
+
+        return sorted(results)
+
+    def watch(self, pathname, bucket_name, workers=1, remote_manifest=False,
+              prefix='', excludes=(), includes=(), delete=False,
+              max_deletes=None):
+        """Sync pathname to the bucket, then keep syncing what changes.
+
+        Yield the results of a full sync, then the results of syncing
+        each batch of changes the watcher (see watch_tree) reports. The
+        manifest stays in memory, so the bucket is listed once and only
+        changed paths are hashed and uploaded. The arguments are the same
+        as for sync, with max_deletes applying to each batch.
+
+        The ETag cache is committed after each batch, so it is not held
+        locked for as long as the watch runs, and a killed watch keeps
+        the hashes it has cached.
+        """
+        root = str(Path(pathname).expanduser().resolve())
+        rules = IgnoreRules.for_root(root, excludes, includes)
+        watcher = watch_tree(root, rules)
+        try:
+            results = self.sync(pathname, bucket_name, workers,
+                                remote_manifest, prefix, excludes, includes,
+                                delete, max_deletes)
+            self.commit_etags()
+            yield results
+            s3_bucket = self.s3.Bucket(bucket_name)
+            prefix = self.normalize_prefix(prefix)
+            while True:
+                changed = watcher.wait()
+                results = self.sync_changes(s3_bucket, root, prefix, rules,
+                                            changed, workers,
+                                            remote_manifest, delete,
+                                            max_deletes)
+                self.commit_etags()
+                yield results
+        finally:
+            watcher.close()
+
+    def sync_changes(self, bucket, root, prefix, rules, relpaths, workers=1,
+                     remote_manifest=False, delete=False, max_deletes=None):
+        """Sync just relpaths under root, against the manifest in memory.
+
+        A relpath naming a file is uploaded if it changed; one naming a
+        directory is walked. With delete, keys for relpaths that no
+        longer exist, and for files gone from a walked directory, are
+        deleted. Return a list of FileResult sorted by key.
+        """
+        files = {}
+        doomed = set()
+        self.walk_errors = []
+
+        def walk_error(relpath, exception):
+            self.walk_errors.append(
+                FileResult(prefix + relpath, 'failed', str(exception)))
+
+        for relpath in relpaths:
+            if relpath and rules.ignored_file(relpath):
+                continue
+            path = os.path.join(root, *relpath.split('/')) if relpath \
+                else root
+            key = prefix + relpath
+            if os.path.isfile(path):
+                try:
+                    files[key] = (path, key, os.stat(path))
+                    continue
+                except FileNotFoundError:
+                    pass
+                except OSError as exception:
+                    walk_error(relpath, exception)
+                    continue
+            walked = set()
+            if os.path.isdir(path):
+                for item in walk(root, rules, relpath, walk_error):
+                    files[prefix + item[1]] = (item[0], prefix + item[1],
+                                               item[2])
+                    walked.add(prefix + item[1])
+            elif key in self.manifest:
+                doomed.add(key)
+                continue
+            if delete:
+                under = key + '/' if relpath else prefix
+                doomed.update(
+                    existing for existing in self.manifest
+                    if existing.startswith(under) and
+                    existing not in walked and
+                    not rules.ignored_file(existing[len(prefix):]))
+
+        results = self.upload_files(bucket, list(files.values()), workers,
+                                    name='watch')
+        results.extend(self.walk_errors)
+        if delete:
+            doomed, refused = self.limit_deletes(
+                sorted(key for key in doomed - files.keys()
+                       if not self.unreadable(key)), max_deletes)
+            results.extend(refused)
+            results.extend(self.delete_keys(bucket, doomed, workers))
+
+        self.update_remote_manifest(bucket, results, remote_manifest)
+        return sorted(results)
+
+    def plan(self, pathname, bucket_name, workers=1, remote_manifest=False,
+             prefix='', excludes=(), includes=(), delete=False,
+             max_deletes=None):
+        """Work out what sync would do, without changing the bucket.
+
+        The arguments are the same as for sync, and the tree is hashed
+        and compared with the manifest by the same code. Return a
+        SyncPlan.
+        """
         s3_bucket = self.s3.Bucket(bucket_name)
-        self.load_manifest(s3_bucket)
-
-        root = Path(pathname).expanduser().resolve()
-
-        def handle_directory(target):
-            for pathitem in target.iterdir():
-                if pathitem.is_dir():
-                    handle_directory(pathitem)
-    #            if p.is_file():
-    #               print("path: {}\n Key: {}".format(
-    #                                          pathitem,
-    #                                  pathitem.relative_to(root).as_posix() ))
-                if pathitem.is_file():
-                    self.upload_file(
-                        s3_bucket,
-                        str(pathitem.as_posix()),
-                        str(pathitem.relative_to(root).as_posix()))
-
-        handle_directory(root)
+        prefix = self.normalize_prefix(prefix)
+        self.load_sync_manifest(s3_bucket, prefix, workers, remote_manifest)
+
+        root = str(Path(pathname).expanduser().resolve())
+        rules = IgnoreRules.for_root(root, excludes, includes)
+        plan = SyncPlan(bucket_name, self.CHUNK_SIZE, self.DELETE_BATCH,
+                        remote_manifest)
+        local_keys = set()
+
+        def compress_file(item):
+            path, key, stat = item
+            local_keys.add(key)
+            try:
+                path, stat = self.precompress_file(path, key, stat)
+            except OSError as exception:
+                plan.failed.append((key, str(exception)))
+                return None
+            return path, key, stat
+
+        def hash_file(item):
+            path, key, stat = item
+            local_keys.add(key)
+            try:
+                etag = self.check_file(path, key, stat)
+            except OSError as exception:
+                plan.failed.append((key, str(exception)))
+                return None
+            if etag is None:
+                plan.skips.append(key)
+            else:
+                plan.uploads.append(PlannedUpload(
+                    path, key, etag, stat.st_size, stat.st_mtime_ns))
+            return None
+
+        pipeline = Pipeline(queue_size=workers * 4)
+        if self.precompressor is not None:
+            pipeline.add_stage('compress', compress_file, workers)
+        pipeline.add_stage('hash', hash_file, workers)
+        for _ in pipeline.run(self.sync_files(root, prefix, rules),
+                              name='walk'):
+            pass
+        self.stage_stats = pipeline.stats
+        plan.failed.extend((result.key, result.error)
+                           for result in self.walk_errors)
+
+        if delete:
+            plan.deletes, refused = self.find_deletes(
+                prefix, local_keys, rules, max_deletes)
+            plan.failed.extend((result.key, result.error)
+                               for result in refused)
+
+        self.evict_etags(root)
+
+        plan.immutable = [upload.key for upload in plan.uploads
+                          if upload.key in self.immutable_keys]
+        plan.encodings = {upload.key: self.content_encodings[upload.key]
+                          for upload in plan.uploads
+                          if upload.key in self.content_encodings}
+        plan.sort()
+        return plan
+
+    def apply_plan(self, plan, workers=1):
+        """Make the changes in a SyncPlan without hashing anything again.
+
+        A file whose size or mtime has changed since the plan was made is
+        reported as failed rather than uploaded. Return a list of
+        FileResult sorted by key.
+        """
+        s3_bucket = self.s3.Bucket(plan.bucket_name)
+        self.limiter = AdaptiveLimiter(workers)
+        self.immutable_keys.update(plan.immutable)
+        self.content_encodings.update(plan.encodings)
+        if plan.remote_manifest:
+            self.load_sync_manifest(s3_bucket, '', workers, True)
+
+        def put_file(upload):
+            try:
+                stat = os.stat(upload.path)
+                if (stat.st_size, stat.st_mtime_ns) != (upload.size,
+                                                        upload.mtime_ns):
+                    return FileResult(upload.key, 'failed',
+                                      'changed since the plan was made')
+                status = self.put_file(s3_bucket, upload.path, upload.key,
+                                       upload.etag)
+            except (BotoCoreError, ClientError, S3UploadFailedError,
+                    OSError) as exception:
+                return FileResult(upload.key, 'failed', str(exception))
+            return FileResult(upload.key, status, None)
+
+        pipeline = Pipeline(queue_size=workers * 4)
+        pipeline.add_stage('upload', put_file, workers)
+        results = list(pipeline.run(plan.uploads, name='plan'))
+        self.stage_stats = pipeline.stats
+        results.extend(self.delete_keys(s3_bucket, plan.deletes, workers))
+
+        self.update_remote_manifest(s3_bucket, results, plan.remote_manifest)
+
+        return sorted(results)
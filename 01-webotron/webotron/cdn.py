@@ -1,29 +1,143 @@
 # -*- coding: utf-8 -*-
 """CDN.py: Configure CloudFront distribution Network."""
 
+import threading
+import time
 import uuid
+from urllib.parse import quote
+
+from webotron.clients import ClientRegistry
+from webotron.lookupcache import LookupCache, plain
+
+SUMMARY_FIELDS = ('Id', 'ARN', 'DomainName', 'Status', 'Enabled', 'Aliases',
+                  'LastModifiedTime')
+
+
+def collapse_paths(keys, max_paths):
+    """Turn object keys into at most max_paths invalidation paths.
+
+    Keys are invalidated exactly if there are few enough of them.
+    Otherwise paths deeper than a given number of directories are cut
+    back to a wildcard for their directory, one level at a time, until
+    they fit, ending with '/*'. An index.html key also invalidates its
+    directory.
+    """
+    paths = set()
+    for key in keys:
+        paths.add('/' + key)
+        if key == 'index.html' or key.endswith('/index.html'):
+            paths.add('/' + key[:-len('index.html')])
+    if not paths:
+        return []
+
+    depth = max(path.count('/') for path in paths)
+    while len(paths) > max_paths and depth > 0:
+        depth -= 1
+        paths = {'/'.join(path.split('/')[:depth + 1]) + '/*'
+                 if path.count('/') > depth else path
+                 for path in paths}
+    if len(paths) > max_paths:
+        paths = {'/*'}
+    return sorted(quote(path, safe='/*-_.~') for path in paths)
+
+
+def dist_summary(dist):
+    """Return the SUMMARY_FIELDS of a dist, listed or just created."""
+    config = dist.get('DistributionConfig', {})
+    dist = dict(dist, Aliases=dist.get('Aliases') or config.get('Aliases'),
+                Enabled=dist.get('Enabled', config.get('Enabled')))
+    return plain({name: dist[name] for name in SUMMARY_FIELDS
+                  if name in dist})
 
 
 class DistributionManager:
     """Manage a CloudFront CDN."""
 
-    def __init__(self, session):
+    CACHE_TTL = 900
+    DEPLOY_DELAY = 5.0
+    DEPLOY_MAX_DELAY = 60.0
+    DEPLOY_BACKOFF = 1.5
+    DEPLOY_TIMEOUT = 1500.0
+
+    def __init__(self, session, clients=None):
         """Create DomainManager object."""
         self.session = session
-        self.client = self.session.client('cloudfront')
+        self.clients = clients or ClientRegistry(session)
+        self.cache = None
+        self.dists = None
+        self.aliases = None
+        self.listed = False
+        self.lock = threading.Lock()
+
+    @property
+    def client(self):
+        """Get the CloudFront client, created on first use."""
+        return self.clients.client('cloudfront')
+
+    def use_cache(self, ttl=CACHE_TTL):
+        """Keep the dist summaries in a LookupCache for ttl seconds."""
+        self.cache = LookupCache.for_session('distributions', self.session,
+                                             ttl)
+
+    def index(self, dist):
+        """Map dist's aliases to it, unless a dist listed earlier has them."""
+        for alias in dist['Aliases'].get('Items', []):
+            self.aliases.setdefault(alias, dist)
+
+    def load_aliases(self, refresh=False):
+        """Get the alias -> dist summary index, cached unless refresh."""
+        with self.lock:
+            if self.aliases is not None and not refresh:
+                return self.aliases
 
-    def find_matching_dist(self, domain_name):
-        """Find a dist matching domain_name."""
-        paginator = self.client.get_paginator('list_distributions')
-        for page in paginator.paginate():
-            for dist in page['DistributionList'].get('Items', []):
-                for alias in dist['Aliases'].get('Items', []):
-                    return dist
-        return None
+            self.dists = None
+            if self.cache is not None and not refresh:
+                self.dists = self.cache.load()
+            self.listed = self.dists is None
+            if self.listed:
+                self.dists = []
+                paginator = self.client.get_paginator('list_distributions')
+                for page in paginator.paginate():
+                    self.dists.extend(
+                        dist_summary(dist)
+                        for dist in page['DistributionList'].get('Items', []))
+                if self.cache is not None:
+                    self.cache.save(self.dists)
+            self.aliases = {}
+            for dist in self.dists:
+                self.index(dist)
+            return self.aliases
 
-    def create_dist(self, domain_name, cert):
-        """Create a dist for domain_name using cert."""
-        origin_id = 'S3-' + domain_name
+    def remember(self, dist):
+        """Add a dist just created to the index (and the cache)."""
+        with self.lock:
+            if self.aliases is None:
+                return
+            summary = dist_summary(dist)
+            self.dists.append(summary)
+            self.index(summary)
+            if self.cache is not None:
+                self.cache.save(self.dists)
+
+    def find_matching_dist(self, domain_name, refresh=False):
+        """Find a dist matching domain_name.
+
+        With refresh, or if the cached dists have none, the dists are
+        listed again.
+        """
+        dist = self.load_aliases(refresh).get(domain_name)
+        if dist is None and not self.listed:
+            dist = self.load_aliases(refresh=True).get(domain_name)
+        return dist
+
+    def create_dist(self, domain_name, cert, bucket_name=None):
+        """Create a dist for domain_name using cert.
+
+        Its origin is the bucket bucket_name, named domain_name if not
+        given.
+        """
+        bucket_name = bucket_name or domain_name
+        origin_id = 'S3-' + bucket_name
 
         result = self.client.create_distribution(
             DistributionConfig={
@@ -40,7 +154,7 @@ class DistributionManager:
                     'Items': [{
                         'Id': origin_id,
                         'DomainName':
-                        '{}.s3.amazonaws.com'.format(domain_name),
+                        '{}.s3.amazonaws.com'.format(bucket_name),
                         'S3OriginConfig': {
                             'OriginAccessIdentity': ''
                         }
@@ -70,13 +184,58 @@ class DistributionManager:
             }
         )
 
+        self.remember(result['Distribution'])
         return result['Distribution']
 
-    def await_deploy(self, dist):
-        """Wait for a deploy to complete."""
-        waiter = self.client.get_waiter('distribution_deployed')
-        waiter.wait(Id=dist['Id'],
+    def await_deploy(self, dist, timeout=DEPLOY_TIMEOUT):
+        """Wait for a deploy to complete.
+
+        The dist is polled at once, again after DEPLOY_DELAY seconds and
+        then less and less often, up to every DEPLOY_MAX_DELAY seconds.
+        Return True once it is deployed, or False if it is not within
+        timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        delay = self.DEPLOY_DELAY
+        while True:
+            status = self.client.get_distribution(
+                Id=dist['Id'])['Distribution']['Status']
+            if status == 'Deployed':
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(self.DEPLOY_MAX_DELAY, delay * self.DEPLOY_BACKOFF)
+
+    def invalidate(self, dist, keys, max_paths=15):
+        """Invalidate the paths of keys in dist.
+
+        See collapse_paths for how keys become at most max_paths paths.
+        Return the invalidation, or None if there was nothing to do.
+        """
+        paths = collapse_paths(keys, max_paths)
+        if not paths:
+            return None
+
+        result = self.client.create_invalidation(
+            DistributionId=dist['Id'],
+            InvalidationBatch={
+                'Paths': {
+                    'Quantity': len(paths),
+                    'Items': paths
+                },
+                'CallerReference': str(uuid.uuid4())
+            }
+        )
+        return result['Invalidation']
+
+    def await_invalidation(self, dist, invalidation):
+        """Wait for an invalidation to complete."""
+        waiter = self.client.get_waiter('invalidation_completed')
+        waiter.wait(DistributionId=dist['Id'],
+                    Id=invalidation['Id'],
                     WaiterConfig={
-                        'Delay': 30,
-                        'MaxAttempts': 50
+                        'Delay': 20,
+                        'MaxAttempts': 60
                     })
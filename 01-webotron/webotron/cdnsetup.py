@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for setting up CloudFront and DNS for several domains."""
+
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+SetupResult = namedtuple('SetupResult', ['domain', 'dist', 'status', 'error'])
+
+
+class CdnSetup:
+    """Point domains at CloudFront dists, doing independent steps at once.
+
+    For each domain, its hosted zone is looked up while its dist is
+    found (or created with a matching cert). The alias record is then
+    upserted while a new dist's deploy is polled, so DNS is ready by the
+    time the dist is. Several domains are set up at once.
+
+    Each SetupResult's status is 'existing' (the dist was already
+    there), 'deployed', 'deploying' (not waited for, or not deployed in
+    time) or 'failed'.
+    """
+
+    def __init__(self, dist_manager, domain_manager, cert_manager,
+                 progress=None):
+        """Create CdnSetup object.
+
+        progress, if given, is called with a line for each step.
+        """
+        self.dist_manager = dist_manager
+        self.domain_manager = domain_manager
+        self.cert_manager = cert_manager
+        self.progress = progress
+        self.lock = threading.Lock()
+
+    def report(self, domain, text):
+        """Report a step of setting up domain."""
+        if self.progress is not None:
+            with self.lock:
+                self.progress('{}: {}'.format(domain, text))
+
+    def setup(self, targets, wait=True, refresh=False, workers=8):
+        """Set up each (domain, bucket_name) in targets.
+
+        With refresh, dists, certs and zones are listed again instead of
+        read from their caches. Return a SetupResult per target, in
+        order.
+        """
+        if refresh:
+            self.dist_manager.load_aliases(refresh=True)
+            self.cert_manager.load_index(refresh=True)
+            self.domain_manager.load_index(refresh=True)
+        with ThreadPoolExecutor(
+                max_workers=min(workers, len(targets))) as executor:
+            return list(executor.map(
+                lambda target: self.setup_domain(*target, wait), targets))
+
+    def find_or_create_dist(self, domain, bucket_name):
+        """Return (dist, created) for domain, or (None, False) if no cert."""
+        dist = self.dist_manager.find_matching_dist(domain)
+        if dist:
+            return dist, False
+        cert = self.cert_manager.find_matching_cert(domain)
+        if not cert:
+            return None, False
+        dist = self.dist_manager.create_dist(domain, cert, bucket_name)
+        self.report(domain, 'created distribution {} with {}'.format(
+            dist['Id'], cert['CertificateArn']))
+        return dist, True
+
+    def setup_domain(self, domain, bucket_name, wait=True):
+        """Point domain at a dist of bucket_name and return a SetupResult.
+
+        The zone is only created once a dist is found, so a domain
+        without a cert leaves nothing behind.
+        """
+        dist = None
+        try:
+            with ThreadPoolExecutor(max_workers=1) as steps:
+                steps.submit(self.domain_manager.find_hosted_zone, domain)
+                dist, created = self.find_or_create_dist(domain, bucket_name)
+                if dist is None:
+                    return SetupResult(domain, None, 'failed',
+                                       'no matching cert')
+
+                def upsert_record():
+                    zone = self.domain_manager.find_or_create_hosted_zone(
+                        domain)
+                    self.domain_manager.create_cf_domain_record(
+                        zone, domain, dist['DomainName'])
+                    self.report(domain, 'alias to {} upserted in {}'.format(
+                        dist['DomainName'], zone['Name']))
+
+                record = steps.submit(upsert_record)
+                status = 'existing'
+                if created:
+                    status = 'deploying'
+                    if wait:
+                        self.report(domain, 'waiting for {} to deploy'.format(
+                            dist['Id']))
+                        if self.dist_manager.await_deploy(dist):
+                            status = 'deployed'
+                record.result()
+        except (BotoCoreError, ClientError) as error:
+            return SetupResult(domain, dist, 'failed', str(error))
+        return SetupResult(domain, dist, status, None)
@@ -2,33 +2,139 @@
 
 """Classes for AWS Certificates."""
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from webotron.clients import ClientRegistry
+from webotron.lookupcache import LookupCache, plain
+
+
+class CertificateIndex:
+    """Find certificates by the names they cover without scanning them all.
+
+    Exact names and wildcard suffixes ('*.example.com' is kept under
+    '.example.com') each map to positions in the listing, so a lookup
+    looks at every suffix of the domain rather than every certificate.
+    Of the certificates that match, the first listed wins.
+    """
+
+    def __init__(self, certificates):
+        """Create CertificateIndex of (summary, sans) in listing order."""
+        self.certificates = certificates
+        self.exact = {}
+        self.wildcards = {}
+        for position, (_, sans) in enumerate(certificates):
+            for name in sans:
+                if name[0] == '*':
+                    self.wildcards.setdefault(name[1:], []).append(position)
+                else:
+                    self.exact.setdefault(name, []).append(position)
+
+    def find(self, domain_name):
+        """Return the summary of the first certificate for domain_name."""
+        positions = list(self.exact.get(domain_name, ()))
+        dot = domain_name.find('.')
+        while dot >= 0:
+            positions.extend(self.wildcards.get(domain_name[dot:], ()))
+            dot = domain_name.find('.', dot + 1)
+        if not positions:
+            return None
+        return self.certificates[min(positions)][0]
+
 
 class CertificateManager:
     """Manager an ACM Certificate."""
 
-    def __init__(self, session):
-        """Initialize CertificateManager."""
+    CACHE_TTL = 900
+
+    def __init__(self, session, clients=None, workers=8):
+        """Initialize CertificateManager.
+
+        Certificates whose names the listing leaves out are described by
+        up to workers threads at once.
+        """
         self.session = session
-        self.client = self.session.client('acm', region_name='us-east-1')
+        self.clients = clients or ClientRegistry(session)
+        self.workers = workers
+        self.cache = None
+        self.index = None
+        self.listed = False
+        self.lock = threading.Lock()
+
+    @property
+    def client(self):
+        """Get the ACM client in us-east-1, created on first use."""
+        return self.clients.client('acm', 'us-east-1')
 
-    def cert_matches(self, cert_arn, domain_name):
-        """Find a cert to use."""
+    def use_cache(self, ttl=CACHE_TTL):
+        """Keep the issued certificates' names in a LookupCache for ttl."""
+        self.cache = LookupCache.for_session('certificates', self.session,
+                                             ttl)
+
+    def cert_sans(self, cert_arn):
+        """Get the names a cert covers."""
         cert_details = self.client.describe_certificate(
             CertificateArn=cert_arn)
-        sans = cert_details['Certificate']['SubjectAlternativeNames']
-        for cert_name in sans:
-            if cert_name == domain_name:
-                return True
-            if cert_name[0] == '*' and domain_name.endswith(cert_name[1:]):
-                return True
-        return False
-
-    def find_matching_cert(self, domain_name):
-        """Find a cert that matches."""
+        return cert_details['Certificate']['SubjectAlternativeNames']
+
+    @staticmethod
+    def summary_sans(cert):
+        """Return the names in a listing's cert summary, or None if partial.
+
+        Summaries list at most 100 names, and older ones none at all.
+        """
+        sans = cert.get('SubjectAlternativeNameSummaries')
+        if sans is None or cert.get('HasAdditionalSubjectAlternativeNames'):
+            return None
+        return sans
+
+    def list_certificates(self):
+        """Return (summary, sans) for each issued cert, in listing order.
+
+        Names come from the listing where it has them all; the rest of
+        the certs are described concurrently.
+        """
+        summaries = []
         paginator = self.client.get_paginator('list_certificates')
         for page in paginator.paginate(CertificateStatuses=['ISSUED']):
-            for cert in page['CertificateSummaryList']:
-                if self.cert_matches(cert['CertificateArn'], domain_name):
-                    return cert
+            summaries.extend(plain(page['CertificateSummaryList']))
+
+        sans = [self.summary_sans(cert) for cert in summaries]
+        missing = [index for index, names in enumerate(sans) if names is None]
+        if missing:
+            with ThreadPoolExecutor(
+                    max_workers=min(self.workers, len(missing))) as executor:
+                described = executor.map(
+                    lambda index: self.cert_sans(
+                        summaries[index]['CertificateArn']), missing)
+                for index, names in zip(missing, described):
+                    sans[index] = names
+        return list(zip(summaries, sans))
+
+    def load_index(self, refresh=False):
+        """Get the CertificateIndex, from the cache unless refresh."""
+        with self.lock:
+            if self.index is not None and not refresh:
+                return self.index
+
+            certificates = None
+            if self.cache is not None and not refresh:
+                certificates = self.cache.load()
+            self.listed = certificates is None
+            if self.listed:
+                certificates = self.list_certificates()
+                if self.cache is not None:
+                    self.cache.save(certificates)
+            self.index = CertificateIndex(certificates)
+            return self.index
+
+    def find_matching_cert(self, domain_name, refresh=False):
+        """Find a cert that matches.
 
-        return None
+        With refresh, or if the cached certs have none, the certs are
+        listed again (so a cert issued since they were cached is found).
+        """
+        cert = self.load_index(refresh).find(domain_name)
+        if cert is None and not self.listed:
+            cert = self.load_index(refresh=True).find(domain_name)
+        return cert
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for sharing AWS clients."""
+
+import threading
+
+from botocore.config import Config
+
+from webotron.stats import Stats
+
+
+class ClientRegistry:
+    """Create AWS clients lazily and share them per (service, region).
+
+    A client is made the first time it is asked for, so a command never
+    pays for clients it does not use. Services with a boto3 resource
+    (RESOURCES) hand out the resource's own client, so both share one
+    connection pool. Pools hold max_pool_connections connections.
+
+    Every client is instrumented by stats, which the managers also use to
+    time their phases.
+    """
+
+    RESOURCES = ('s3',)
+
+    def __init__(self, session, max_pool_connections=10, stats=None):
+        """Create ClientRegistry object for session."""
+        self.session = session
+        self.stats = stats or Stats(enabled=False)
+        self.max_pool_connections = max_pool_connections
+        self.clients = {}
+        self.resources = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, connections):
+        """Pool at least connections connections in clients made from now."""
+        self.max_pool_connections = max(self.max_pool_connections,
+                                        connections)
+
+    def config(self):
+        """Return the botocore Config new clients are made with."""
+        return Config(max_pool_connections=self.max_pool_connections,
+                      retries={'mode': 'standard'})
+
+    def resource(self, service, region_name=None):
+        """Get the boto3 resource for service in region_name."""
+        key = (service, region_name or self.session.region_name)
+        resource = self.resources.get(key)
+        if resource is None:
+            with self.lock:
+                resource = self.resources.get(key)
+                if resource is None:
+                    resource = self.session.resource(
+                        service, region_name=key[1], config=self.config())
+                    self.stats.instrument(resource.meta.client)
+                    self.resources[key] = resource
+        return resource
+
+    def client(self, service, region_name=None):
+        """Get the client for service in region_name."""
+        if service in self.RESOURCES:
+            return self.resource(service, region_name).meta.client
+        key = (service, region_name or self.session.region_name)
+        client = self.clients.get(key)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(key)
+                if client is None:
+                    client = self.session.client(
+                        service, region_name=key[1], config=self.config())
+                    self.stats.instrument(client)
+                    self.clients[key] = client
+        return client
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for precompressing text files before upload."""
+
+import gzip
+import mimetypes
+import os
+import tempfile
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Precompressor:
+    """Compress text files before they are uploaded.
+
+    Compressed copies are kept in cache_dir, named after the ETag of the
+    source file, so an unchanged file is never compressed twice and its
+    compressed copy keeps the same stat (and so its cached ETag). Using
+    a copy only sets its atime, which prune goes by.
+    Compression is deterministic, so the same source always gives the
+    same compressed object.
+    """
+
+    CACHE_DIR = os.path.join('~', '.cache', 'webotron', 'compressed')
+    TYPES = (
+        'application/javascript', 'application/json', 'application/xml',
+        'application/manifest+json', 'application/wasm', 'image/svg+xml',
+        'image/x-icon'
+    )
+    MAX_AGE = 30 * 24 * 60 * 60
+
+    def __init__(self, encoding='gzip', cache_dir=CACHE_DIR):
+        """Create a Precompressor using encoding 'gzip' or 'br'."""
+        if encoding == 'br' and brotli is None:
+            raise RuntimeError('Brotli compression needs brotli installed.')
+        self.encoding = encoding
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir),
+                                      encoding)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def eligible(self, key):
+        """Return True if key's content type is worth compressing."""
+        content_type = mimetypes.guess_type(key)[0]
+        return bool(content_type) and (content_type.startswith('text/') or
+                                       content_type in self.TYPES)
+
+    def compress_data(self, data):
+        """Return data compressed with this encoding."""
+        if self.encoding == 'br':
+            return brotli.compress(data, quality=11)
+        return gzip.compress(data, compresslevel=9, mtime=0)
+
+    def compress(self, path, etag):
+        """Return the path of path's compressed copy.
+
+        etag is path's ETag. Return None if compressing does not make the
+        file smaller.
+        """
+        artifact = os.path.join(self.cache_dir, etag.strip('"'))
+        try:
+            stat = os.stat(artifact)
+            os.utime(artifact, ns=(time.time_ns(), stat.st_mtime_ns))
+        except FileNotFoundError:
+            with open(path, 'rb') as source:
+                data = self.compress_data(source.read())
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir,
+                                             delete=False) as staged:
+                staged.write(data)
+            os.replace(staged.name, artifact)
+
+        if os.path.getsize(artifact) >= os.path.getsize(path):
+            return None
+        return artifact
+
+    def prune(self):
+        """Delete copies not used for MAX_AGE and return their paths."""
+        oldest = time.time() - self.MAX_AGE
+        pruned = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_atime < oldest:
+                        os.remove(entry.path)
+                        pruned.append(entry.path)
+                except FileNotFoundError:
+                    pass
+        return pruned
@@ -2,34 +2,122 @@
 
 """Classes for Route 53 domains."""
 
+import threading
 import uuid
 
+from webotron.clients import ClientRegistry
+from webotron.lookupcache import LookupCache
+
+
+class ZoneIndex:
+    """Find the hosted zone for a domain by its longest matching suffix.
+
+    Zones are kept by name without the trailing dot. A public zone is
+    preferred to a private one of the same name.
+    """
+
+    def __init__(self, zones):
+        """Create ZoneIndex of the hosted zones in zones."""
+        self.zones = {}
+        for zone in zones:
+            self.add(zone)
+
+    def add(self, zone):
+        """Index zone, unless it is private and a public one has its name."""
+        name = zone['Name'].rstrip('.')
+        known = self.zones.get(name)
+        if known is None or known['Config'].get('PrivateZone', False):
+            self.zones[name] = zone
+
+    def find(self, domain_name):
+        """Return the zone for the longest suffix of domain_name."""
+        labels = domain_name.rstrip('.').split('.')
+        for start in range(len(labels)):
+            zone = self.zones.get('.'.join(labels[start:]))
+            if zone is not None:
+                return zone
+        return None
+
 
 class DomainManager:
     """Manage a Route 53 domain."""
 
-    def __init__(self, session):
+    CACHE_TTL = 900
+
+    def __init__(self, session, clients=None):
         """Create DomainManager object."""
         self.session = session
-        self.client = self.session.client('route53')
+        self.clients = clients or ClientRegistry(session)
+        self.cache = None
+        self.zones = None
+        self.index = None
+        self.listed = False
+        self.lock = threading.RLock()
 
-    def find_hosted_zone(self, domain_name):
-        """Find zone matching domain_name."""
-        paginator = self.client.get_paginator('list_hosted_zones')
-        for page in paginator.paginate():
-            for zone in page['HostedZones']:
-                if domain_name.endswith(zone['Name'][:-1]):
-                    return zone
+    @property
+    def client(self):
+        """Get the Route 53 client, created on first use."""
+        return self.clients.client('route53')
 
-        return None
+    def use_cache(self, ttl=CACHE_TTL):
+        """Keep the hosted zones in a LookupCache for ttl seconds."""
+        self.cache = LookupCache.for_session('zones', self.session, ttl)
+
+    def load_index(self, refresh=False):
+        """Get the ZoneIndex, from the cache unless refresh."""
+        with self.lock:
+            if self.index is not None and not refresh:
+                return self.index
+
+            self.zones = None
+            if self.cache is not None and not refresh:
+                self.zones = self.cache.load()
+            self.listed = self.zones is None
+            if self.listed:
+                self.zones = []
+                paginator = self.client.get_paginator('list_hosted_zones')
+                for page in paginator.paginate():
+                    self.zones.extend(page['HostedZones'])
+                if self.cache is not None:
+                    self.cache.save(self.zones)
+            self.index = ZoneIndex(self.zones)
+            return self.index
+
+    def find_hosted_zone(self, domain_name, refresh=False):
+        """Find zone matching domain_name.
+
+        The zone whose name is the longest suffix of domain_name wins.
+        With refresh, or if the cached zones have none, the zones are
+        listed again.
+        """
+        zone = self.load_index(refresh).find(domain_name)
+        if zone is None and not self.listed:
+            zone = self.load_index(refresh=True).find(domain_name)
+        return zone
 
     def create_hosted_zone(self, domain_name):
         """Create a hosted zone to match domain_name."""
         zone_name = '.'.join(domain_name.split('.')[-2:]) + '.'
-        return self.client.create_hosted_zone(
+        zone = self.client.create_hosted_zone(
             Name=zone_name,
             CallerReference=str(uuid.uuid4())
-        )
+        )['HostedZone']
+        with self.lock:
+            if self.index is not None:
+                self.zones.append(zone)
+                self.index.add(zone)
+                if self.cache is not None:
+                    self.cache.save(self.zones)
+        return zone
+
+    def find_or_create_hosted_zone(self, domain_name, refresh=False):
+        """Find the zone for domain_name, creating one if there is none.
+
+        Callers on other threads wait, so a zone is only created once.
+        """
+        with self.lock:
+            return self.find_hosted_zone(domain_name, refresh) \
+                or self.create_hosted_zone(domain_name)
 
     def create_s3_domain_record(self, zone, domain_name, endpoint):
         """Create a domain record in zone for domain_name."""
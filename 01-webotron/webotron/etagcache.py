@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for the local ETag cache."""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class EtagCache:
+    """Remember the ETag of local files between syncs.
+
+    Rows are keyed by path and are only trusted while the file's size,
+    mtime_ns and inode, and the chunk size used to hash it, are unchanged.
+
+    New rows are held in memory and written in one short transaction
+    once FLUSH_ROWS of them or FLUSH_SECONDS have built up, and the
+    database is in WAL mode, so several syncs can share the cache at
+    once. A cache that stays locked or is broken only costs hashing:
+    lookups miss and writes are dropped.
+    """
+
+    DEFAULT_PATH = os.path.join('~', '.cache', 'webotron', 'etags.sqlite')
+    FLUSH_ROWS = 512
+    FLUSH_SECONDS = 5.0
+    TIMEOUT = 5.0
+
+    def __init__(self, filename=DEFAULT_PATH):
+        """Open (and create if needed) the cache database."""
+        filename = os.path.expanduser(filename)
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.pending = {}
+        self.flushed = time.monotonic()
+        self.db = sqlite3.connect(filename, timeout=self.TIMEOUT,
+                                  check_same_thread=False)
+        try:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.Error:
+            pass
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS etags ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER, mtime_ns INTEGER, inode INTEGER,'
+            ' chunk_size INTEGER, etag TEXT)')
+
+    def lookup(self, path, stat, chunk_size):
+        """Return the cached etag for path, or None if it is stale."""
+        with self.lock:
+            self.seen.add(path)
+            row = self.pending.get(path)
+            if row is not None:
+                row = row[1:]
+            else:
+                try:
+                    row = self.db.execute(
+                        'SELECT size, mtime_ns, inode, chunk_size, etag'
+                        ' FROM etags WHERE path = ?', (path,)).fetchone()
+                except sqlite3.Error:
+                    return None
+        if row and row[:4] == (stat.st_size, stat.st_mtime_ns,
+                               stat.st_ino, chunk_size):
+            return row[4]
+        return None
+
+    def store(self, path, stat, chunk_size, etag):
+        """Remember etag for path as it was when stat was taken."""
+        with self.lock:
+            self.seen.add(path)
+            self.pending[path] = (path, stat.st_size, stat.st_mtime_ns,
+                                  stat.st_ino, chunk_size, etag)
+            if (len(self.pending) >= self.FLUSH_ROWS or
+                    time.monotonic() - self.flushed >= self.FLUSH_SECONDS):
+                self.flush()
+
+    def evict(self, root):
+        """Drop rows under root that were not looked up since opening."""
+        root = root.rstrip('/') + '/'
+        with self.lock:
+            try:
+                with self.db:
+                    paths = self.db.execute(
+                        'SELECT path FROM etags WHERE path >= ? AND path < ?',
+                        (root, root[:-1] + '0')).fetchall()
+                    self.db.executemany(
+                        'DELETE FROM etags WHERE path = ?',
+                        [row for row in paths if row[0] not in self.seen])
+            except sqlite3.Error:
+                pass
+
+    def forget(self, paths):
+        """Drop the rows for paths."""
+        with self.lock:
+            for path in paths:
+                self.pending.pop(path, None)
+            try:
+                with self.db:
+                    self.db.executemany('DELETE FROM etags WHERE path = ?',
+                                        [(path,) for path in paths])
+            except sqlite3.Error:
+                pass
+
+    def flush(self):
+        """Write the pending rows in one transaction; hold the lock."""
+        rows, self.pending = list(self.pending.values()), {}
+        self.flushed = time.monotonic()
+        if not rows:
+            return
+        try:
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO etags VALUES (?, ?, ?, ?, ?, ?)',
+                    rows)
+        except sqlite3.Error:
+            pass
+
+    def commit(self):
+        """Write the pending rows to disk, keeping the cache open."""
+        with self.lock:
+            self.flush()
+
+    def close(self):
+        """Write the cache to disk and close it."""
+        with self.lock:
+            self.flush()
+            self.db.close()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for syncing one tree to several buckets."""
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError
+
+from webotron.bucket import BucketManager, FileResult
+from webotron.manifest import Manifest
+from webotron.pipeline import Pipeline
+from webotron.throttle import AdaptiveLimiter
+from webotron.walker import IgnoreRules
+
+
+class FanOut:
+    """Sync one tree to several buckets, walking and hashing it once.
+
+    Each bucket has its own BucketManager, with a client in the bucket's
+    region and its own manifest. The first manager compresses and hashes
+    each file once; every target then compares it with its own manifest
+    and uploads it from its own pipeline. Each target's queue holds at
+    most `workers` * 4 files, so memory stays bounded; a slow region
+    only holds up the others once its queue is full.
+    """
+
+    SHARED = (
+        'etag_cache', 'hash_threads', 'dedup', 'metadata_rules',
+        'fingerprinter', 'precompressor', 'content_encodings',
+        'immutable_keys', 'bandwidth', 'transfer_config', 'regions'
+    )
+    PROGRESS_INTERVAL = 5.0
+    DONE = object()
+
+    def __init__(self, managers, progress=None):
+        """Create FanOut object for a dict of bucket name to manager.
+
+        progress, if given, is called with a line of per-bucket progress
+        at most every PROGRESS_INTERVAL seconds.
+        """
+        self.managers = managers
+        self.progress = progress
+        self.queued = dict.fromkeys(managers, 0)
+        self.done = dict.fromkeys(managers, 0)
+        self.reported = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_buckets(cls, template, bucket_names, progress=None):
+        """Create FanOut object with a manager per bucket set up like template.
+
+        Settings in SHARED are shared with template rather than copied.
+        """
+        managers = {}
+        for bucket_name in bucket_names:
+            manager = BucketManager(
+                template.session,
+                template.get_region_name(template.s3.Bucket(bucket_name)),
+                template.clients)
+            for name in cls.SHARED:
+                setattr(manager, name, getattr(template, name))
+            manager.manifest = Manifest(spill=template.manifest.spill)
+            managers[bucket_name] = manager
+        return cls(managers, progress)
+
+    def sync(self, pathname, workers=1, remote_manifest=False, prefix='',
+             excludes=(), includes=(), delete=False, max_deletes=None):
+        """Sync pathname to every bucket.
+
+        The arguments are as for BucketManager.sync, with `workers`
+        upload threads for each bucket. Return a dict of bucket name to
+        its list of FileResult, sorted by key.
+        """
+        primary = next(iter(self.managers.values()))
+        prefix = BucketManager.normalize_prefix(prefix)
+        root = str(Path(pathname).expanduser().resolve())
+        rules = IgnoreRules.for_root(root, excludes, includes)
+        buckets = {name: manager.s3.Bucket(name)
+                   for name, manager in self.managers.items()}
+        queues = {name: queue.Queue(workers * 4) for name in self.managers}
+        results = {name: [] for name in self.managers}
+        local_keys = set()
+
+        with ThreadPoolExecutor(max_workers=len(self.managers)) as executor:
+            list(executor.map(
+                lambda name: self.managers[name].load_sync_manifest(
+                    buckets[name], prefix, workers, remote_manifest),
+                self.managers))
+
+            uploads = {name: executor.submit(self.upload, name, buckets[name],
+                                             queues[name], workers)
+                       for name in self.managers}
+            try:
+                hash_stats = self.hash_tree(primary.sync_files(
+                    root, prefix, rules), workers, queues, uploads, results,
+                    local_keys)
+            finally:
+                for name, files in queues.items():
+                    self.enqueue(files, uploads[name], self.DONE)
+            for name, upload in uploads.items():
+                uploaded, upload_stats = upload.result()
+                results[name].extend(uploaded)
+                results[name].extend(primary.walk_errors)
+                self.managers[name].walk_errors = primary.walk_errors
+                self.managers[name].stage_stats = hash_stats + upload_stats
+
+            if delete:
+                deleted = executor.map(
+                    lambda name: self.delete(name, buckets[name], prefix,
+                                             local_keys, rules, max_deletes,
+                                             workers),
+                    self.managers)
+                for name, name_results in zip(self.managers, deleted):
+                    results[name].extend(name_results)
+
+        primary.evict_etags(root)
+        for name, manager in self.managers.items():
+            manager.update_remote_manifest(buckets[name], results[name],
+                                           remote_manifest)
+        return {name: sorted(results[name]) for name in self.managers}
+
+    @staticmethod
+    def enqueue(files, upload, item):
+        """Put item on a target's bounded queue, waiting while it is full.
+
+        Return False, dropping item, if upload (the future of the target's
+        upload) is done, as it is when its pipeline raised.
+        """
+        while not upload.done():
+            try:
+                files.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def hash_tree(self, files, workers, queues, uploads, results,
+                  local_keys):
+        """Compress and hash files once, queueing them for each target.
+
+        A file each target already has is recorded as skipped there.
+        Return the stage stats of hashing.
+        """
+        primary = next(iter(self.managers.values()))
+
+        def fail(key, exception):
+            for name in self.managers:
+                results[name].append(FileResult(key, 'failed',
+                                                str(exception)))
+
+        def compress_file(item):
+            path, key, stat = item
+            local_keys.add(key)
+            try:
+                path, stat = primary.precompress_file(path, key, stat)
+            except OSError as exception:
+                fail(key, exception)
+                return None
+            return path, key, stat
+
+        def hash_file(item):
+            path, key, stat = item
+            local_keys.add(key)
+            try:
+                etag = primary.get_etag(path, stat)
+            except OSError as exception:
+                fail(key, exception)
+                return None
+            for name, manager in self.managers.items():
+                if manager.manifest.get(key, '') == etag:
+                    results[name].append(FileResult(key, 'skipped', None))
+                else:
+                    with self.lock:
+                        self.queued[name] += 1
+                    if not self.enqueue(queues[name], uploads[name],
+                                        (path, key, etag)):
+                        with self.lock:
+                            self.queued[name] -= 1
+            return None
+
+        pipeline = Pipeline(queue_size=workers * 4)
+        if primary.precompressor is not None:
+            pipeline.add_stage('compress', compress_file, workers)
+        pipeline.add_stage('hash', hash_file, workers)
+        for _ in pipeline.run(files, name='walk'):
+            pass
+        return pipeline.stats
+
+    def upload(self, name, bucket, files, workers):
+        """Upload the files queued for bucket until DONE.
+
+        Return (list of FileResult, stage stats).
+        """
+        manager = self.managers[name]
+        manager.limiter = AdaptiveLimiter(workers)
+
+        def put_file(item):
+            path, key, etag = item
+            try:
+                status = manager.put_file(bucket, path, key, etag)
+            except (BotoCoreError, ClientError, S3UploadFailedError,
+                    OSError) as exception:
+                status, error = 'failed', str(exception)
+            else:
+                error = None
+            self.advance(name)
+            return FileResult(key, status, error)
+
+        pipeline = Pipeline(queue_size=workers * 4)
+        pipeline.add_stage('upload', put_file, workers)
+        uploaded = list(pipeline.run(iter(files.get, self.DONE),
+                                     name='queue'))
+        return uploaded, pipeline.stats
+
+    def delete(self, name, bucket, prefix, local_keys, rules, max_deletes,
+               workers):
+        """Delete the keys bucket has that the tree does not."""
+        manager = self.managers[name]
+        doomed, refused = manager.find_deletes(prefix, local_keys, rules,
+                                               max_deletes)
+        return refused + manager.delete_keys(bucket, doomed, workers)
+
+    def advance(self, name):
+        """Count an upload to name done, reporting progress if it is time."""
+        with self.lock:
+            self.done[name] += 1
+            now = time.monotonic()
+            if self.progress is None or \
+                    now - self.reported < self.PROGRESS_INTERVAL:
+                return
+            self.reported = now
+            line = ', '.join('{}: {}/{}'.format(
+                bucket_name, self.done[bucket_name], self.queued[bucket_name])
+                for bucket_name in self.managers)
+        self.progress(line)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+"""Rename assets after their content and rewrite references to them."""
+
+import hashlib
+import os
+import posixpath
+import re
+from urllib.parse import urlsplit
+
+from webotron.walker import glob_to_regex, walk
+
+HTML_REFERENCE = re.compile(
+    r'''((?:src|href)\s*=\s*["'])([^"']+)(["'])''', re.IGNORECASE)
+CSS_REFERENCE = re.compile(
+    r'''(url\(\s*["']?|@import\s+["'])([^"')]+)(["']?)''', re.IGNORECASE)
+
+
+def compile_globs(patterns):
+    """Compile name globs into one regex."""
+    return re.compile('|'.join('(?:.*/)?' + glob_to_regex(pattern)
+                               for pattern in patterns))
+
+
+class Fingerprinter:
+    """Give assets names that change with their content.
+
+    Assets matching ASSETS are renamed from app.js to app.<hash>.js, so
+    they can be served as immutable. HTML and CSS files have references
+    to renamed assets rewritten. Rewritten files are written to
+    stage_dir, and only when their content changes, so their stat (and
+    so the ETag cache) stays valid between syncs.
+    """
+
+    ASSETS = ('*.css', '*.js', '*.mjs', '*.png', '*.jpg', '*.jpeg', '*.gif',
+              '*.svg', '*.webp', '*.avif', '*.woff', '*.woff2', '*.ttf',
+              '*.otf', '*.eot')
+    REWRITE = ('*.html', '*.htm', '*.css')
+    HASH_LENGTH = 8
+    STAGE_ROOT = os.path.join('~', '.cache', 'webotron', 'fingerprint')
+
+    def __init__(self, stage_dir):
+        """Create a Fingerprinter writing rewritten files to stage_dir."""
+        self.stage_dir = os.path.expanduser(stage_dir)
+        self.assets = compile_globs(self.ASSETS)
+        self.rewrite = compile_globs(self.REWRITE)
+        self.renamed = {}
+        self.staged = {}
+
+    @classmethod
+    def for_root(cls, root):
+        """Create a Fingerprinter with a stage_dir of its own for root."""
+        name = hashlib.md5(os.path.realpath(os.path.expanduser(root))
+                           .encode('utf-8')).hexdigest()
+        return cls(os.path.join(cls.STAGE_ROOT, name))
+
+    def prepare(self, root, rules=None, get_etag=None):
+        """Work out the new name of every asset under root.
+
+        CSS is renamed after its own references are rewritten, so a
+        stylesheet's name changes when an image (or a stylesheet) it
+        uses changes. Stylesheets are rewritten after those they use.
+
+        get_etag(path, stat), if given, supplies the digest of the other
+        assets, so BucketManager.get_etag can answer from its ETag cache.
+        """
+        stylesheets = {}
+        for path, relpath, stat in walk(root, rules):
+            if not self.assets.fullmatch(relpath):
+                continue
+            if relpath.endswith('.css'):
+                with open(path, 'rb') as stylesheet:
+                    stylesheets[relpath] = stylesheet.read()
+                continue
+            if get_etag is not None:
+                digest = get_etag(path, stat).strip('"')
+            else:
+                digest = hashlib.md5()
+                with open(path, 'rb') as asset:
+                    for block in iter(lambda: asset.read(1 << 20), b''):
+                        digest.update(block)
+                digest = digest.hexdigest()
+            self.renamed[relpath] = self.hashed_name(relpath, digest)
+
+        for relpath in self.dependency_order(stylesheets):
+            content = self.rewrite_references(stylesheets[relpath], relpath)
+            self.renamed[relpath] = self.hashed_name(
+                relpath, hashlib.md5(content).hexdigest())
+            self.staged[relpath] = self.stage(relpath, content)
+
+    def dependency_order(self, stylesheets):
+        """Return the relpaths of stylesheets, each after those it uses.
+
+        stylesheets maps relpath to content. In an @import cycle, the
+        stylesheet reached first is rewritten first.
+        """
+        order, done, visiting = [], set(), set()
+        for start in sorted(stylesheets):
+            stack = [(start, None)]
+            while stack:
+                relpath, uses = stack.pop()
+                if uses is None:
+                    if relpath in done or relpath in visiting:
+                        continue
+                    visiting.add(relpath)
+                    uses = iter(sorted(
+                        target for target in self.references(
+                            stylesheets[relpath], relpath)
+                        if target in stylesheets))
+                used = next(uses, None)
+                if used is None:
+                    visiting.discard(relpath)
+                    done.add(relpath)
+                    order.append(relpath)
+                    continue
+                stack.append((relpath, uses))
+                stack.append((used, None))
+        return order
+
+    def hashed_name(self, relpath, digest):
+        """Return relpath with the start of hex digest before its extension."""
+        stem, extension = posixpath.splitext(relpath)
+        return '{}.{}{}'.format(stem, digest[:self.HASH_LENGTH], extension)
+
+    @staticmethod
+    def resolve(reference, directory):
+        """Return the relpath reference points to from directory, or None."""
+        parts = urlsplit(reference)
+        if parts.scheme or parts.netloc or not parts.path:
+            return None
+        if parts.path.startswith('/'):
+            return posixpath.normpath(parts.path.lstrip('/'))
+        return posixpath.normpath(posixpath.join(directory, parts.path))
+
+    def references(self, content, relpath):
+        """Yield the relpaths the CSS content of file relpath refers to."""
+        text = content.decode('utf-8', 'surrogateescape')
+        directory = posixpath.dirname(relpath)
+        for match in CSS_REFERENCE.finditer(text):
+            target = self.resolve(match.group(2), directory)
+            if target is not None:
+                yield target
+
+    def rewrite_references(self, content, relpath):
+        """Return content, of file relpath, with asset references renamed."""
+        text = content.decode('utf-8', 'surrogateescape')
+        directory = posixpath.dirname(relpath)
+
+        def rename(match):
+            reference = match.group(2)
+            target = self.resolve(reference, directory)
+            if target not in self.renamed:
+                return match.group(0)
+            path = urlsplit(reference).path
+            new_path = posixpath.join(
+                posixpath.dirname(path),
+                posixpath.basename(self.renamed[target]))
+            return '{}{}{}'.format(
+                match.group(1),
+                reference.replace(path, new_path, 1),
+                match.group(3))
+
+        if relpath.endswith('.css'):
+            text = CSS_REFERENCE.sub(rename, text)
+        else:
+            text = HTML_REFERENCE.sub(rename, text)
+        return text.encode('utf-8', 'surrogateescape')
+
+    def stage(self, relpath, content):
+        """Write content for relpath under stage_dir if it has changed."""
+        path = os.path.join(self.stage_dir, *relpath.split('/'))
+        try:
+            with open(path, 'rb') as existing:
+                if existing.read() == content:
+                    return path
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as staged:
+            staged.write(content)
+        return path
+
+    def transform(self, files):
+        """Map walked (path, relpath, stat) to what should be uploaded."""
+        for path, relpath, stat in files:
+            if relpath in self.staged:
+                path = self.staged[relpath]
+                stat = os.stat(path)
+            elif self.rewrite.fullmatch(relpath):
+                with open(path, 'rb') as source:
+                    original = source.read()
+                content = self.rewrite_references(original, relpath)
+                if content != original:
+                    path = self.stage(relpath, content)
+                    stat = os.stat(path)
+            yield path, self.renamed.get(relpath, relpath), stat
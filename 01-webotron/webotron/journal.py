@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for journaling sync progress so it can be resumed."""
+
+import json
+import os
+import threading
+import time
+from hashlib import md5
+
+from webotron.manifest import read_manifest, write_manifest
+
+
+class SyncJournal:
+    """An append-only record of a sync's progress, for sync --resume.
+
+    Each line is one JSON entry:
+    - done: key was uploaded (or already current) from a file of the
+      given size and mtime_ns, with the given etag.
+    - create: a multipart upload was started for key.
+    - part: one part of a multipart upload was uploaded.
+    - end: a multipart upload was completed or aborted.
+
+    A journal kept for --resume has a snapshot of the manifest alongside
+    it, so a resumed sync need not list the bucket again. A journal left
+    by a sync that was killed has none, and the bucket is listed.
+    """
+
+    DIRECTORY = os.path.join('~', '.cache', 'webotron', 'journals')
+    FSYNC_INTERVAL = 1.0
+
+    def __init__(self, path):
+        """Create SyncJournal object for the journal file at path."""
+        self.path = path
+        self.snapshot_path = path + '.manifest.gz'
+        self.done = {}
+        self.uploads = {}
+        self.file = None
+        self.synced = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_sync(cls, directory, root, bucket_name, prefix):
+        """Return the journal for syncing root to bucket_name at prefix."""
+        name = md5(json.dumps([root, bucket_name, prefix]).encode(
+            'utf-8')).hexdigest()
+        return cls(os.path.join(os.path.expanduser(directory),
+                                name + '.jsonl'))
+
+    def exists(self):
+        """Return True if an earlier sync left this journal behind."""
+        return os.path.exists(self.path)
+
+    def replay(self):
+        """Load the entries of an earlier sync's journal.
+
+        A torn last line, from a sync that died mid-write, is ignored.
+        """
+        if not self.exists():
+            return
+        with open(self.path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    self.apply(json.loads(line))
+                except (ValueError, KeyError):
+                    break
+
+    def apply(self, entry):
+        """Apply one journal entry to the in-memory state."""
+        op = entry['op']
+        if op == 'done':
+            self.done[entry['key']] = (entry['etag'], entry['size'],
+                                       entry['mtime_ns'])
+        elif op == 'create':
+            self.uploads[entry['upload_id']] = dict(entry, parts={})
+        elif op == 'part':
+            self.uploads[entry['upload_id']]['parts'][
+                entry['part']] = entry['etag']
+        elif op == 'end':
+            self.uploads.pop(entry['upload_id'], None)
+
+    def open(self):
+        """Open the journal for appending."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def record(self, op, **entry):
+        """Append an entry, fsyncing at most every FSYNC_INTERVAL."""
+        entry['op'] = op
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.apply(entry)
+            self.file.write(line)
+            self.file.flush()
+            now = time.monotonic()
+            if now - self.synced >= self.FSYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.synced = now
+
+    def completed(self, key, stat):
+        """Return key's etag if it was done from a file matching stat."""
+        done = self.done.get(key)
+        if done and done[1:] == (stat.st_size, stat.st_mtime_ns):
+            return done[0]
+        return None
+
+    def resumable(self, key, etag, size):
+        """Return (upload_id, parts) of an open upload of etag to key."""
+        with self.lock:
+            for upload_id, upload in self.uploads.items():
+                if (upload['key'], upload['etag'], upload['size']) == (
+                        key, etag, size):
+                    return upload_id, dict(upload['parts'])
+        return None
+
+    def open_uploads(self):
+        """Return (upload_id, key) for each multipart upload left open."""
+        with self.lock:
+            return [(upload_id, upload['key'])
+                    for upload_id, upload in self.uploads.items()]
+
+    def save_snapshot(self, entries):
+        """Save the manifest's (key, etag, size) entries, streamed."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.snapshot_path, 'wb') as snapshot:
+            write_manifest(entries, snapshot)
+
+    def read_snapshot(self):
+        """Yield the saved entries.
+
+        Raise ValueError if there is no snapshot or it cannot be read.
+        """
+        try:
+            snapshot = open(self.snapshot_path, 'rb')
+        except OSError as exception:
+            raise ValueError(str(exception)) from exception
+        with snapshot:
+            yield from read_manifest(snapshot)
+
+    def close(self):
+        """Close the journal, keeping it for a later --resume."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        """Close and delete the journal and its snapshot."""
+        self.close()
+        for path in (self.path, self.snapshot_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for caching AWS lookups between commands."""
+
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from hashlib import md5
+
+
+def plain(value):
+    """Return value, an API response item, with datetimes as ISO strings."""
+    if isinstance(value, dict):
+        return {name: plain(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class LookupCache:
+    """A JSON file of looked up AWS state, trusted for ttl seconds.
+
+    Caches are kept per set of credentials, so profiles for different
+    accounts never see each other's state.
+    """
+
+    DIRECTORY = os.path.join('~', '.cache', 'webotron', 'lookups')
+
+    def __init__(self, path, ttl):
+        """Create LookupCache object for the file at path."""
+        self.path = path
+        self.ttl = ttl
+
+    @classmethod
+    def for_session(cls, name, session, ttl, directory=DIRECTORY):
+        """Return the cache called name for session's credentials."""
+        credentials = session.get_credentials()
+        owner = credentials.access_key if credentials else ''
+        return cls(os.path.join(
+            os.path.expanduser(directory), '{}-{}.json'.format(
+                name, md5(owner.encode('utf-8')).hexdigest()[:16])), ttl)
+
+    def load(self):
+        """Return the cached data, or None if it is missing or stale."""
+        try:
+            with open(self.path, encoding='utf-8') as cache:
+                saved = json.load(cache)
+            if 0 <= time.time() - saved['saved'] < self.ttl:
+                return saved['data']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def save(self, data):
+        """Replace the cached data with data."""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False,
+                                         encoding='utf-8') as cache:
+            json.dump({'saved': time.time(), 'data': data}, cache)
+        os.replace(cache.name, self.path)
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for the manifest of objects in a bucket."""
+
+import gzip
+import heapq
+import io
+import json
+import mmap
+import struct
+import tempfile
+import threading
+from array import array
+from operator import itemgetter
+
+MANIFEST_KEY = '.webotron-manifest.json.gz'
+MANIFEST_VERSION = 2
+MANIFEST_HEADER = json.dumps({'version': MANIFEST_VERSION},
+                             separators=(',', ':')).encode('utf-8') + b'\n'
+WRITE_BATCH = 4096
+
+
+def write_manifest(entries, fileobj):
+    """Write (key, etag, size) entries, in key order, to fileobj.
+
+    The manifest is gzipped JSON lines: a version header, then one
+    [key, etag, size] array per line, so it is written as entries
+    stream out of a Manifest rather than built in memory.
+    """
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0) as stream:
+        stream.write(MANIFEST_HEADER)
+        lines = []
+        for entry in entries:
+            lines.append(encode(entry))
+            if len(lines) >= WRITE_BATCH:
+                stream.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                lines = []
+        if lines:
+            stream.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def read_manifest(fileobj):
+    """Yield the (key, etag, size) entries of the manifest in fileobj.
+
+    Raise ValueError, possibly after yielding some entries, if fileobj is
+    not a manifest this version can read or its keys are out of order.
+    """
+    try:
+        with gzip.GzipFile(fileobj=fileobj, mode='rb') as stream:
+            if stream.readline(len(MANIFEST_HEADER)) != MANIFEST_HEADER:
+                raise ValueError('not a version {} manifest'.format(
+                    MANIFEST_VERSION))
+            last_key = None
+            for line in stream:
+                key, etag, size = json.loads(line)
+                if not (isinstance(key, str) and isinstance(etag, str) and
+                        isinstance(size, int)):
+                    raise ValueError('bad manifest entry')
+                if last_key is not None and key <= last_key:
+                    raise ValueError('manifest keys out of order')
+                last_key = key
+                yield key, etag, size
+    except (OSError, EOFError, TypeError) as exception:
+        raise ValueError(str(exception)) from exception
+
+
+def split_etag(etag):
+    """Split a quoted S3 ETag into its raw md5 digest and part count.
+
+    The part count is 0 for a single part upload. Return None if etag is
+    not an md5 based ETag.
+    """
+    value = etag.strip('"')
+    hexdigest, _, parts = value.partition('-')
+    try:
+        digest = bytes.fromhex(hexdigest)
+        parts = int(parts) if parts else 0
+    except ValueError:
+        return None
+    if len(digest) != 16 or not 0 <= parts < 2 ** 32:
+        return None
+    return digest, parts
+
+
+def join_etag(digest, parts):
+    """Build the quoted S3 ETag for a digest and part count."""
+    if parts:
+        return '"{}-{}"'.format(digest.hex(), parts)
+    return '"{}"'.format(digest.hex())
+
+
+class Manifest:
+    """Compact key -> (ETag, size) map of the objects in a bucket.
+
+    Entries are packed into flat columns: the UTF-8 keys back to back in
+    sorted order with an offset table, the raw 16 byte md5 digests, the
+    part counts and the sizes. Lookups are a binary search over the keys.
+    With spill the columns live in temporary files that are mmap'd rather
+    than held in memory.
+
+    Entries are added in bulk (ideally in sorted order, as S3 lists them)
+    until the first lookup packs them. Entries added or removed after
+    that, and any ETag that is not md5 based, are kept in a small dict on
+    the side.
+    """
+
+    COLUMNS = ('keys', 'offsets', 'digests', 'parts', 'sizes')
+    FLUSH_EVERY = 4096
+
+    def __init__(self, spill=False):
+        """Create an empty manifest."""
+        self.spill = spill
+        self.lock = threading.Lock()
+        self.changes = {}
+        self.changed_etags = {}
+        self.etag_index = None
+        self.count = 0
+        self.is_sorted = True
+        self.last_key = None
+        self.views = None
+        self.maps = []
+        self.files = {name: tempfile.TemporaryFile() if spill else io.BytesIO()
+                      for name in self.COLUMNS}
+        self.key_length = 0
+        self.pending = self.new_pending()
+        self.pending['offsets'].append(0)
+
+    @staticmethod
+    def new_pending():
+        """Return empty buffers for entries not yet written to columns."""
+        return {
+            'keys': bytearray(),
+            'offsets': array('Q'),
+            'digests': bytearray(),
+            'parts': array('I'),
+            'sizes': array('Q')
+        }
+
+    def add(self, key, etag, size):
+        """Record that key holds an object with etag and size."""
+        split = split_etag(etag)
+        if self.views is not None or split is None:
+            self.changes[key] = (etag, size)
+            self.changed_etags[etag] = key
+            return
+
+        self.changes.pop(key, None)
+        encoded = key.encode('utf-8')
+        if self.last_key is not None and encoded <= self.last_key:
+            self.is_sorted = False
+        self.last_key = encoded
+
+        self.key_length += len(encoded)
+        self.pending['keys'] += encoded
+        self.pending['offsets'].append(self.key_length)
+        self.pending['digests'] += split[0]
+        self.pending['parts'].append(split[1])
+        self.pending['sizes'].append(size)
+        self.count += 1
+        if len(self.pending['sizes']) >= self.FLUSH_EVERY:
+            self.flush()
+
+    def remove(self, key):
+        """Record that key no longer exists."""
+        self.freeze()
+        self.changes[key] = None
+
+    def flush(self):
+        """Write pending entries to the column files."""
+        for name, buffer in self.pending.items():
+            self.files[name].write(buffer)
+        self.pending = self.new_pending()
+
+    def freeze(self):
+        """Pack the entries added so far so they can be looked up."""
+        with self.lock:
+            if self.views is not None:
+                return
+            self.flush()
+            if not self.is_sorted:
+                self.resort()
+            views = {}
+            for name, column in self.files.items():
+                if self.spill:
+                    column.flush()
+                    if column.tell():
+                        self.maps.append(mmap.mmap(column.fileno(), 0,
+                                                   access=mmap.ACCESS_READ))
+                        view = memoryview(self.maps[-1])
+                    else:
+                        view = memoryview(b'')
+                else:
+                    view = column.getbuffer()
+                if name in ('offsets', 'sizes'):
+                    view = view.cast('Q')
+                elif name == 'parts':
+                    view = view.cast('I')
+                views[name] = view
+            self.views = views
+
+    def resort(self):
+        """Rewrite the columns in key order, keeping the last duplicate."""
+        entries = {}
+        views = {}
+        for name, column in self.files.items():
+            column.seek(0)
+            views[name] = column.read()
+        offsets = memoryview(views['offsets']).cast('Q')
+        parts = memoryview(views['parts']).cast('I')
+        sizes = memoryview(views['sizes']).cast('Q')
+        for index in range(self.count):
+            key = views['keys'][offsets[index]:offsets[index + 1]]
+            entries[key] = (
+                views['digests'][index * 16:index * 16 + 16],
+                parts[index], sizes[index])
+        del views, offsets, parts, sizes
+
+        for column in self.files.values():
+            column.seek(0)
+            column.truncate()
+        self.count = 0
+        self.key_length = 0
+        self.last_key = None
+        self.is_sorted = True
+        self.pending['offsets'].append(0)
+        for key in sorted(entries):
+            digest, part_count, size = entries[key]
+            self.add(key.decode('utf-8'), join_etag(digest, part_count), size)
+        self.flush()
+
+    def find_etag(self, etag):
+        """Return a key that holds an object with etag, or None."""
+        key = self.changed_etags.get(etag)
+        if key is not None and self.get(key) == etag:
+            return key
+
+        split = split_etag(etag)
+        if split is None:
+            return None
+        self.freeze()
+        with self.lock:
+            if self.etag_index is None:
+                self.etag_index = self.build_etag_index()
+        index = self.etag_index
+
+        # Records are 16 byte digest, 4 byte part count, 4 byte index.
+        wanted = split[0] + struct.pack('>I', split[1])
+        low, high = 0, len(index) // 24
+        while low < high:
+            middle = (low + high) // 2
+            if index[middle * 24:middle * 24 + 20] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        while index[low * 24:low * 24 + 20] == wanted:
+            entry, = struct.unpack_from('>I', index, low * 24 + 20)
+            key = self.key_at(entry).decode('utf-8')
+            if key not in self.changes:
+                return key
+            low += 1
+        return None
+
+    def build_etag_index(self):
+        """Return sorted (digest, parts, index) records of packed entries."""
+        digests = self.views['digests']
+        parts = self.views['parts']
+        return b''.join(sorted(
+            bytes(digests[index * 16:index * 16 + 16]) +
+            struct.pack('>II', parts[index], index)
+            for index in range(self.count)))
+
+    def key_at(self, index):
+        """Return the UTF-8 key of packed entry index."""
+        offsets = self.views['offsets']
+        return bytes(self.views['keys'][offsets[index]:offsets[index + 1]])
+
+    def bisect(self, encoded):
+        """Return the packed index of the first key not below encoded."""
+        if self.views is None:
+            self.freeze()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_at(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, key):
+        """Return the packed index of key, or None."""
+        encoded = key.encode('utf-8')
+        index = self.bisect(encoded)
+        if index < self.count and self.key_at(index) == encoded:
+            return index
+        return None
+
+    def entry(self, index):
+        """Return (etag, size) of packed entry index."""
+        digest = bytes(self.views['digests'][index * 16:index * 16 + 16])
+        return (join_etag(digest, self.views['parts'][index]),
+                self.views['sizes'][index])
+
+    def lookup(self, key):
+        """Return (etag, size) for key, or None."""
+        if key in self.changes:
+            return self.changes[key]
+        index = self.find(key)
+        if index is None:
+            return None
+        return self.entry(index)
+
+    def get(self, key, default=None):
+        """Return the ETag for key, or default."""
+        found = self.lookup(key)
+        return default if found is None else found[0]
+
+    def size(self, key, default=None):
+        """Return the size of the object at key, or default."""
+        found = self.lookup(key)
+        return default if found is None else found[1]
+
+    def __contains__(self, key):
+        """Return True if key is in the manifest."""
+        return self.lookup(key) is not None
+
+    def __len__(self):
+        """Return the number of keys in the manifest."""
+        return self.count + sum(
+            (value is not None) - (self.find(key) is not None)
+            for key, value in self.changes.items())
+
+    def __iter__(self):
+        """Iterate over keys in sorted order."""
+        for key, _, _ in self.items():
+            yield key
+
+    def items(self, start_after=None):
+        """Iterate over (key, etag, size) in key order.
+
+        With start_after, only keys after it are included.
+        """
+        self.freeze()
+        changes = dict(self.changes)
+        first = 0
+        if start_after is not None:
+            encoded = start_after.encode('utf-8')
+            first = self.bisect(encoded)
+            if first < self.count and self.key_at(first) == encoded:
+                first += 1
+            changes = {key: value for key, value in changes.items()
+                       if key > start_after}
+
+        def packed():
+            for index in range(first, self.count):
+                key = self.key_at(index).decode('utf-8')
+                if key not in changes:
+                    yield (key,) + self.entry(index)
+
+        changed = ((key,) + changes[key] for key in sorted(changes)
+                   if changes[key] is not None)
+        yield from heapq.merge(packed(), changed, key=itemgetter(0))
+
+    def close(self):
+        """Release the mmaps and column files."""
+        self.views = None
+        for view in self.maps:
+            view.close()
+        for column in self.files.values():
+            column.close()
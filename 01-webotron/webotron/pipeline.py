@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for running work through stages of threads."""
+
+import queue
+import threading
+import time
+from collections import namedtuple
+
+StageStats = namedtuple('StageStats', ['name', 'items', 'busy', 'wall'])
+
+
+class Pipeline:
+    """Run items through stages of worker threads joined by bounded queues.
+
+    Each stage function takes an item and returns the item for the next
+    stage, or None to drop it. What the last stage returns is yielded by
+    run(). A full queue blocks the stage feeding it, so no more than
+    queue_size items wait between any two stages.
+    """
+
+    DONE = object()
+
+    def __init__(self, queue_size=64):
+        """Create a pipeline with no stages."""
+        self.queue_size = queue_size
+        self.stages = []
+        self.stats = []
+
+    def add_stage(self, name, func, workers=1):
+        """Add a stage of workers threads running func on each item."""
+        self.stages.append((name, func, workers))
+        return self
+
+    def run(self, source, name='source'):
+        """Feed the items of source through the stages.
+
+        Yield what the last stage returns, as soon as it returns it.
+        An exception raised by source or a stage function stops the
+        pipeline and is raised again here.
+        """
+        stop = threading.Event()
+        errors = []
+        lock = threading.Lock()
+        queues = [queue.Queue(self.queue_size)
+                  for _ in range(len(self.stages) + 1)]
+        counts = [1] + [workers for _, _, workers in self.stages]
+        readers = [workers for _, _, workers in self.stages] + [1]
+        timings = [[name, 0, 0.0, None, None]]
+        timings.extend([stage[0], 0, 0.0, None, None] for stage in self.stages)
+
+        def put(index, item):
+            while not stop.is_set():
+                try:
+                    queues[index].put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def get(index):
+            while not stop.is_set():
+                try:
+                    return queues[index].get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return self.DONE
+
+        def record(index, started):
+            finished = time.perf_counter()
+            with lock:
+                timing = timings[index]
+                timing[1] += 1
+                timing[2] += finished - started
+                if timing[3] is None:
+                    timing[3] = started
+                timing[4] = finished
+
+        def finish(index):
+            with lock:
+                counts[index] -= 1
+                last = counts[index] == 0
+            if last:
+                for _ in range(readers[index]):
+                    put(index, self.DONE)
+
+        def feed():
+            items = iter(source)
+            try:
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    item = next(items, self.DONE)
+                    if item is self.DONE:
+                        break
+                    record(0, started)
+                    put(0, item)
+            except Exception as exception:
+                errors.append(exception)
+                stop.set()
+            finally:
+                finish(0)
+
+        def work(index):
+            func = self.stages[index][1]
+            try:
+                while True:
+                    item = get(index)
+                    if item is self.DONE:
+                        break
+                    started = time.perf_counter()
+                    result = func(item)
+                    record(index + 1, started)
+                    if result is not None:
+                        put(index + 1, result)
+            except Exception as exception:
+                errors.append(exception)
+                stop.set()
+            finally:
+                finish(index + 1)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for index, (_, _, workers) in enumerate(self.stages):
+            threads.extend(threading.Thread(target=work, args=(index,),
+                                            daemon=True)
+                           for _ in range(workers))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = get(len(self.stages))
+                if item is self.DONE:
+                    break
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.stats = [
+                StageStats(stage, items, busy,
+                           end - start if start is not None else 0.0)
+                for stage, items, busy, start, end in timings]
+
+        if errors:
+            raise errors[0]
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for sync plans."""
+
+import json
+from collections import namedtuple
+
+PlannedUpload = namedtuple('PlannedUpload',
+                           ['path', 'key', 'etag', 'size', 'mtime_ns'])
+
+
+class SyncPlan:
+    """The changes a sync would make to a bucket."""
+
+    VERSION = 1
+
+    def __init__(self, bucket_name, chunk_size, delete_batch,
+                 remote_manifest=False):
+        """Create an empty plan for bucket_name."""
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size
+        self.delete_batch = delete_batch
+        self.remote_manifest = remote_manifest
+        self.uploads = []
+        self.skips = []
+        self.deletes = []
+        self.failed = []
+        self.immutable = []
+        self.encodings = {}
+
+    def sort(self):
+        """Put every list in the plan in key order."""
+        self.uploads.sort(key=lambda upload: upload.key)
+        self.skips.sort()
+        self.deletes.sort()
+        self.failed.sort()
+        self.immutable.sort()
+
+    def upload_bytes(self):
+        """Return the number of bytes the plan uploads."""
+        return sum(upload.size for upload in self.uploads)
+
+    def requests(self):
+        """Estimate the S3 requests applying the plan will make."""
+        puts = multipart = parts = 0
+        for upload in self.uploads:
+            if upload.size < self.chunk_size:
+                puts += 1
+            else:
+                multipart += 1
+                parts += -(-upload.size // self.chunk_size)
+        return {
+            'put': puts,
+            'multipart_uploads': multipart,
+            'multipart_parts': parts,
+            'delete': -(-len(self.deletes) // self.delete_batch)
+        }
+
+    def to_json(self):
+        """Return the plan as a JSON string."""
+        return json.dumps({
+            'version': self.VERSION,
+            'bucket': self.bucket_name,
+            'chunk_size': self.chunk_size,
+            'delete_batch': self.delete_batch,
+            'remote_manifest': self.remote_manifest,
+            'upload_bytes': self.upload_bytes(),
+            'requests': self.requests(),
+            'uploads': [upload._asdict() for upload in self.uploads],
+            'skips': self.skips,
+            'deletes': self.deletes,
+            'immutable': self.immutable,
+            'encodings': self.encodings,
+            'failed': [{'key': key, 'error': error}
+                       for key, error in self.failed]
+        }, indent=2)
+
+    @classmethod
+    def from_json(cls, text):
+        """Load a plan written by to_json."""
+        data = json.loads(text)
+        if data.get('version') != cls.VERSION:
+            raise ValueError('Unsupported plan version: {}'.format(
+                data.get('version')))
+        plan = cls(data['bucket'], data['chunk_size'], data['delete_batch'],
+                   data['remote_manifest'])
+        plan.uploads = [PlannedUpload(**upload) for upload in data['uploads']]
+        plan.skips = data['skips']
+        plan.deletes = data['deletes']
+        plan.immutable = data.get('immutable', [])
+        plan.encodings = data.get('encodings', {})
+        plan.failed = [(failed['key'], failed['error'])
+                       for failed in data['failed']]
+        return plan
+
+    def summary(self):
+        """Return the plan as lines of text."""
+        lines = ['upload: {} ({} bytes)'.format(upload.key, upload.size)
+                 for upload in self.uploads]
+        lines.extend('skip: {}'.format(key) for key in self.skips)
+        lines.extend('delete: {}'.format(key) for key in self.deletes)
+        lines.extend('failed: {}: {}'.format(key, error)
+                     for key, error in self.failed)
+        requests = self.requests()
+        lines.append(
+            'Upload {} ({} bytes), skip {}, delete {}, failed {}'.format(
+                len(self.uploads), self.upload_bytes(), len(self.skips),
+                len(self.deletes), len(self.failed)))
+        lines.append(
+            'Requests: {} PUT, {} multipart uploads ({} parts), '
+            '{} DELETE'.format(requests['put'], requests['multipart_uploads'],
+                               requests['multipart_parts'],
+                               requests['delete']))
+        return lines
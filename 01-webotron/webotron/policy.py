@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for choosing the metadata objects are uploaded with."""
+
+import json
+import re
+
+from webotron.walker import glob_to_regex
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class MetadataRules:
+    """A table of glob -> extra upload arguments.
+
+    Every rule whose glob matches a key applies, in order, so later
+    rules override earlier ones. Globs follow IgnoreRules: one without a
+    '/' matches the last part of the key, one with a '/' the whole key.
+
+    Rules only affect objects as they are uploaded: changing a rule does
+    not re-upload objects whose content is unchanged.
+    """
+
+    ALLOWED_ARGS = (
+        'CacheControl', 'ContentDisposition', 'ContentEncoding',
+        'ContentLanguage', 'ContentType', 'Expires', 'Metadata',
+        'StorageClass', 'WebsiteRedirectLocation'
+    )
+
+    def __init__(self, rules):
+        """Compile rules, a list of (glob, extra args dict)."""
+        self.rules = []
+        for pattern, args in rules:
+            unknown = set(args) - set(self.ALLOWED_ARGS)
+            if unknown:
+                raise ValueError('Unknown upload arguments for {}: {}'.format(
+                    pattern, ', '.join(sorted(unknown))))
+            if '/' in pattern:
+                regex = glob_to_regex(pattern.lstrip('/'))
+            else:
+                regex = '(?:.*/)?' + glob_to_regex(pattern)
+            self.rules.append((re.compile(regex), dict(args)))
+
+    @classmethod
+    def from_file(cls, filename):
+        """Load rules from a JSON file.
+
+        The file holds a list of objects, each with a "match" glob and
+        the upload arguments to use, for example:
+        [{"match": "*.html", "CacheControl": "no-cache"}]
+        """
+        with open(filename) as rules_file:
+            rules = json.load(rules_file)
+        try:
+            return cls([(rule.pop('match'), rule) for rule in rules])
+        except (AttributeError, KeyError, TypeError):
+            raise ValueError('Each rule needs a "match" glob.')
+
+    def args_for(self, key):
+        """Return the extra upload arguments for key."""
+        args = {}
+        for regex, rule_args in self.rules:
+            if regex.fullmatch(key):
+                args.update(rule_args)
+        return args
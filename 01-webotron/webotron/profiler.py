@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for profiling a command across all of its threads."""
+
+import cProfile
+import pstats
+import sys
+import threading
+
+
+class ThreadProfiler:
+    """Profile the main thread and every thread started after it, merged.
+
+    A cProfile.Profile only sees the thread that enabled it, and the
+    main thread of a sync mostly waits on its pipeline's queues, so each
+    new thread enables its own profiler from a threading.setprofile hook.
+    Their stats are merged into one pstats file.
+
+    From Python 3.12 one enabled profiler sees every thread and a second
+    cannot be enabled, so there the main thread's profiler covers them.
+    """
+
+    def __init__(self):
+        """Create ThreadProfiler object."""
+        self.main = cProfile.Profile()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def profile_thread(self, frame, event, arg):
+        """Give the thread this is first called in its own profiler."""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.threads.append(profile)
+
+    def start(self):
+        """Start profiling this thread and the threads started from now."""
+        threading.setprofile(self.profile_thread)
+        self.main.enable()
+
+    def dump(self, path):
+        """Stop profiling and save the merged pstats data to path."""
+        self.main.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(self.main)
+        with self.lock:
+            for profile in self.threads:
+                stats.add(profile)
+        stats.dump_stats(path)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for counting AWS calls and timing the phases of a command."""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, float('inf'))
+
+
+def request_size(request):
+    """Return the bytes of payload a botocore request sends."""
+    for header in ('X-Amz-Decoded-Content-Length', 'Content-Length'):
+        if request.headers.get(header):
+            return int(request.headers[header])
+    try:
+        return len(request.body or b'')
+    except TypeError:
+        return 0
+
+
+def response_size(http_response, model=None):
+    """Return the bytes of payload a botocore response received."""
+    if http_response is None:
+        return 0
+    if http_response.headers.get('Content-Length'):
+        return int(http_response.headers['Content-Length'])
+    if model is not None and not model.has_streaming_output:
+        return len(http_response.content or b'')
+    return 0
+
+
+class OperationStats:
+    """Counts for one (service, operation)."""
+
+    def __init__(self):
+        """Create OperationStats object with everything at zero."""
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds):
+        """Add one call's latency to the histogram."""
+        self.calls += 1
+        self.seconds += seconds
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+    def as_dict(self):
+        """Return the counts as a dict, with a cumulative histogram."""
+        cumulative, histogram = 0, {}
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            cumulative += count
+            histogram['+Inf' if bound == float('inf') else str(bound)] = \
+                cumulative
+        return {
+            'calls': self.calls, 'retries': self.retries,
+            'errors': self.errors, 'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received, 'seconds': self.seconds,
+            'histogram': histogram
+        }
+
+
+class Stats:
+    """Count AWS API calls and time the phases of a command.
+
+    instrument() hooks a botocore client's events to count calls, retries,
+    errors and bytes and to build a latency histogram per operation.
+    phase() and timed() add up the time spent in named phases. A Stats
+    that is not enabled instruments nothing and times nothing.
+    """
+
+    FORMATS = ('human', 'json', 'prometheus')
+
+    def __init__(self, enabled=True):
+        """Create Stats object."""
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.operations = {}
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def instrument(self, client):
+        """Register hooks on client's events, if enabled."""
+        if not self.enabled:
+            return
+        service = client.meta.service_model.service_name
+        events = client.meta.events
+        events.register('before-call', self.before_call)
+        events.register('request-created', self.request_created)
+        events.register('after-call',
+                        lambda **kwargs: self.after_call(service, **kwargs))
+        events.register('after-call-error',
+                        lambda **kwargs: self.after_call(service, **kwargs))
+
+    def before_call(self, model, context, **kwargs):
+        """Note when a call started."""
+        context['webotron_stats'] = [model.name, time.perf_counter(), 0, 0]
+
+    def request_created(self, request, **kwargs):
+        """Count an attempt at a call and the bytes it sends."""
+        call = getattr(request, 'context', {}).get('webotron_stats')
+        if call is None:
+            return
+        call[2] += 1
+        call[3] += request_size(request)
+
+    def after_call(self, service, context, http_response=None,
+                   exception=None, model=None, **kwargs):
+        """Record a finished call."""
+        call = context.get('webotron_stats')
+        if call is None:
+            return
+        operation, started, attempts, sent = call
+        seconds = time.perf_counter() - started
+        received = response_size(http_response, model)
+        with self.lock:
+            stats = self.operations.setdefault((service, operation),
+                                               OperationStats())
+            stats.observe(seconds)
+            stats.retries += max(0, attempts - 1)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            if exception is not None or (http_response is not None and
+                                         http_response.status_code >= 300):
+                stats.errors += 1
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in a with block to phase name."""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self.lock:
+                phase = self.phases.setdefault(name, [0, 0.0, 0.0])
+                phase[0] += 1
+                phase[1] += seconds
+                phase[2] = max(phase[2], seconds)
+
+    def timed(self, name, iterable):
+        """Yield from iterable, adding the time it takes to phase name."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def as_dict(self):
+        """Return everything counted as a dict."""
+        with self.lock:
+            return {
+                'elapsed': time.perf_counter() - self.started,
+                'operations': [
+                    dict(stats.as_dict(), service=service,
+                         operation=operation)
+                    for (service, operation), stats
+                    in sorted(self.operations.items())],
+                'phases': {name: {'count': count, 'seconds': seconds,
+                                  'max': longest}
+                           for name, (count, seconds, longest)
+                           in sorted(self.phases.items())}
+            }
+
+    def human(self):
+        """Return the stats as lines of text."""
+        data = self.as_dict()
+        lines = ['Elapsed {:.2f}s'.format(data['elapsed'])]
+        for stats in data['operations']:
+            lines.append(
+                '{service} {operation}: {calls} calls, {retries} retries, '
+                '{errors} errors, {bytes_sent} bytes sent, {bytes_received} '
+                'bytes received, {mean:.1f}ms mean'.format(
+                    mean=1000 * stats['seconds'] / stats['calls'], **stats))
+        for name, phase in data['phases'].items():
+            lines.append('{}: {} times, {:.2f}s total, {:.1f}ms max'.format(
+                name, phase['count'], phase['seconds'], 1000 * phase['max']))
+        return lines
+
+    def to_json(self):
+        """Return the stats as a JSON string."""
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self):
+        """Return the stats in the Prometheus text exposition format."""
+        data = self.as_dict()
+        lines = []
+
+        def metric(name, kind, text, samples):
+            lines.append('# HELP webotron_{} {}'.format(name, text))
+            lines.append('# TYPE webotron_{} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(*label)
+                                      for label in labels)
+                lines.append('webotron_{}{}{} {}'.format(
+                    name, suffix,
+                    '{' + label_text + '}' if label_text else '', value))
+
+        def labels(stats):
+            return (('service', stats['service']),
+                    ('operation', stats['operation']))
+
+        operations = data['operations']
+        for name, field, text in (
+                ('api_calls_total', 'calls', 'AWS API calls made.'),
+                ('api_retries_total', 'retries', 'AWS API calls retried.'),
+                ('api_errors_total', 'errors', 'AWS API calls that failed.'),
+                ('api_sent_bytes_total', 'bytes_sent',
+                 'Bytes sent in AWS API requests.'),
+                ('api_received_bytes_total', 'bytes_received',
+                 'Bytes received in AWS API responses.')):
+            metric(name, 'counter', text,
+                   [('', labels(stats), stats[field])
+                    for stats in operations])
+        samples = []
+        for stats in operations:
+            samples.extend(('_bucket', labels(stats) + (('le', bound),),
+                            count)
+                           for bound, count in stats['histogram'].items())
+            samples.append(('_sum', labels(stats), stats['seconds']))
+            samples.append(('_count', labels(stats), stats['calls']))
+        metric('api_latency_seconds', 'histogram', 'AWS API call latency.',
+               samples)
+        phases = data['phases'].items()
+        metric('phase_seconds_total', 'counter', 'Time spent in each phase.',
+               [('', (('phase', name),), phase['seconds'])
+                for name, phase in phases])
+        metric('phase_runs_total', 'counter', 'Times each phase ran.',
+               [('', (('phase', name),), phase['count'])
+                for name, phase in phases])
+        metric('elapsed_seconds', 'gauge', 'How long the command ran.',
+               [('', (), data['elapsed'])])
+        return '\n'.join(lines) + '\n'
+
+    def report(self, stats_format):
+        """Return the stats as text in stats_format."""
+        if stats_format == 'json':
+            return self.to_json()
+        if stats_format == 'prometheus':
+            return self.to_prometheus()
+        return '\n'.join(self.human())
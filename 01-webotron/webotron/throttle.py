@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for adapting upload concurrency and bandwidth to S3."""
+
+import threading
+import time
+from contextlib import contextmanager
+
+THROTTLE_CODES = frozenset([
+    'SlowDown', 'ServiceUnavailable', 'RequestLimitExceeded', 'Throttling',
+    'ThrottlingException', 'RequestThrottled', 'TooManyRequestsException',
+    '503'
+])
+
+
+def is_throttle(response):
+    """Return True if a botocore response is S3 asking us to slow down."""
+    if response is None:
+        return False
+    http_response, parsed = response
+    return (getattr(http_response, 'status_code', None) == 503 or
+            parsed.get('Error', {}).get('Code') in THROTTLE_CODES)
+
+
+class AdaptiveLimiter:
+    """Limit concurrent requests, adapting the limit to throttling.
+
+    The limit grows by one for every `limit` successful requests and
+    halves on a throttle (additive increase, multiplicative decrease),
+    between 1 and maximum. A burst of throttles from requests that were
+    already in flight only halves it once every COOLDOWN seconds.
+    """
+
+    COOLDOWN = 1.0
+
+    def __init__(self, maximum):
+        """Create an AdaptiveLimiter starting at maximum."""
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.lowest = maximum
+        self.active = 0
+        self.throttles = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot under the current limit and take it."""
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        """Give a slot back."""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for the duration of a with block."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def success(self):
+        """Record a request that was not throttled."""
+        with self.condition:
+            if self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.condition.notify_all()
+
+    def throttle(self):
+        """Record a throttled request."""
+        with self.condition:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self.last_decrease >= self.COOLDOWN:
+                self.last_decrease = now
+                self.limit = max(1.0, self.limit / 2)
+                self.lowest = min(self.lowest, int(self.limit))
+
+    def current(self):
+        """Return the current limit as a whole number of requests."""
+        return int(self.limit)
+
+
+class BandwidthLimiter:
+    """Cap the bytes per second shared by all uploads with a token bucket.
+
+    consume() is used as an s3transfer progress Callback: it sleeps the
+    uploading thread until the bytes it has just sent are paid for.
+    """
+
+    def __init__(self, bytes_per_second):
+        """Create a BandwidthLimiter allowing bytes_per_second."""
+        self.rate = bytes_per_second
+        self.tokens = float(bytes_per_second)
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take amount bytes, sleeping if they are over the rate."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""Walk a local tree for sync, skipping ignored files."""
+
+import os
+import re
+
+IGNORE_FILE = '.webotronignore'
+
+
+def glob_to_regex(pattern):
+    """Translate a gitignore style glob into a regular expression.
+
+    '*' and '?' do not match '/', '**' matches across directories.
+    """
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith('**/', index):
+            regex.append('(?:.*/)?')
+            index += 3
+        elif pattern.startswith('**', index):
+            regex.append('.*')
+            index += 2
+        elif char == '*':
+            regex.append('[^/]*')
+            index += 1
+        elif char == '?':
+            regex.append('[^/]')
+            index += 1
+        elif char == '[' and ']' in pattern[index + 2:]:
+            end = pattern.index(']', index + 2)
+            body = pattern[index + 1:end].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex.append('[' + body + ']')
+            index = end + 1
+        else:
+            regex.append(re.escape(char))
+            index += 1
+    return ''.join(regex)
+
+
+class IgnoreRules:
+    """Decide which paths in a tree sync should leave out.
+
+    Patterns follow .gitignore: a pattern without a '/' matches a name at
+    any depth, one with a '/' matches the path from the root, and one
+    ending in '/' only matches directories. Include patterns re-include
+    paths an exclude pattern matched. Files under an excluded directory
+    are never visited.
+    """
+
+    DEFAULT_EXCLUDES = (
+        '.git/', '.hg/', '.svn/', 'node_modules/', '__pycache__/',
+        '.DS_Store', 'Thumbs.db', '*.swp', '*~', IGNORE_FILE
+    )
+
+    def __init__(self, excludes=(), includes=()):
+        """Compile the exclude and include patterns."""
+        self.excludes = self.compile(excludes)
+        self.includes = self.compile(includes)
+
+    @classmethod
+    def for_root(cls, root, excludes=(), includes=()):
+        """Build the rules for root, reading its .webotronignore.
+
+        Lines of the ignore file starting with '!' are include patterns.
+        """
+        excludes = list(cls.DEFAULT_EXCLUDES) + list(excludes)
+        includes = list(includes)
+        try:
+            with open(os.path.join(root, IGNORE_FILE)) as ignore_file:
+                for line in ignore_file:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    if line.startswith('!'):
+                        includes.append(line[1:])
+                    else:
+                        excludes.append(line)
+        except FileNotFoundError:
+            pass
+        return cls(excludes, includes)
+
+    @staticmethod
+    def compile(patterns):
+        """Compile patterns into one regex for any path and one for dirs."""
+        any_path, dirs_only = [], []
+        for pattern in patterns:
+            target = dirs_only if pattern.endswith('/') else any_path
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if '/' in pattern:
+                target.append(glob_to_regex(pattern.lstrip('/')))
+            else:
+                target.append('(?:.*/)?' + glob_to_regex(pattern))
+        return tuple(re.compile('|'.join(regexes)) if regexes else None
+                     for regexes in (any_path, dirs_only))
+
+    @staticmethod
+    def matches(compiled, relpath, is_dir):
+        """Return True if relpath matches compiled patterns."""
+        any_path, dirs_only = compiled
+        return bool((any_path and any_path.fullmatch(relpath)) or
+                    (is_dir and dirs_only and dirs_only.fullmatch(relpath)))
+
+    def ignored(self, relpath, is_dir=False):
+        """Return True if sync should leave out relpath."""
+        return (self.matches(self.excludes, relpath, is_dir) and
+                not self.matches(self.includes, relpath, is_dir))
+
+    def ignored_file(self, relpath):
+        """Return True if relpath or any directory above it is ignored."""
+        parts = relpath.split('/')
+        return (any(self.ignored('/'.join(parts[:depth]), True)
+                    for depth in range(1, len(parts))) or
+                self.ignored(relpath))
+
+
+def walk(root, rules=None, start='', onerror=None):
+    """Yield (path, relpath, stat) for every file under root.
+
+    The tree is walked with os.scandir and an explicit stack, so deep
+    trees cannot hit the recursion limit. The stat of each file is the
+    one its DirEntry already holds. relpath always uses '/'.
+
+    start, a relpath of a directory under root, walks just that part of
+    the tree.
+
+    Files and directories that vanish while the tree is walked are left
+    out. Any other error reading one is passed to onerror, if given, as
+    onerror(relpath, exception), and the walk carries on without it.
+    """
+    if start:
+        stack = [(os.path.join(root, *start.split('/')), start + '/')]
+    else:
+        stack = [(root, '')]
+    while stack:
+        directory, relative = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    relpath = relative + entry.name
+                    if entry.is_dir():
+                        if rules is None or not rules.ignored(relpath, True):
+                            stack.append((entry.path, relpath + '/'))
+                    elif entry.is_file():
+                        if rules is not None and rules.ignored(relpath):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except (FileNotFoundError, NotADirectoryError):
+                            continue
+                        except OSError as exception:
+                            if onerror is not None:
+                                onerror(relpath, exception)
+                            continue
+                        yield entry.path, relpath, stat
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        except OSError as exception:
+            if onerror is not None:
+                onerror(relative.rstrip('/'), exception)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for watching a tree for changes to sync."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from webotron.walker import walk
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Watcher:
+    """Collect the relpaths under root that change, coalescing bursts.
+
+    A relpath may name a file or a directory that was added, changed or
+    removed; '' means anything under root may have changed.
+    """
+
+    DEBOUNCE = 0.2
+    MAX_DELAY = 2.0
+
+    def __init__(self, root, rules):
+        """Create Watcher object for root, leaving out what rules ignore."""
+        self.root = root
+        self.rules = rules
+
+    def poll(self, timeout):
+        """Return the relpaths changed within timeout seconds."""
+        raise NotImplementedError
+
+    def wait(self):
+        """Block until something changes and return what changed.
+
+        Events keep being collected until none arrive for DEBOUNCE
+        seconds, or for MAX_DELAY seconds at most, so a burst of writes
+        is synced once.
+        """
+        changed = set()
+        while not changed:
+            changed = self.poll(None)
+        deadline = time.monotonic() + self.MAX_DELAY
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            more = self.poll(min(self.DEBOUNCE, remaining))
+            if not more:
+                break
+            changed.update(more)
+        return changed
+
+    def close(self):
+        """Stop watching."""
+
+
+class PollingWatcher(Watcher):
+    """Find changes by walking the tree every INTERVAL seconds."""
+
+    INTERVAL = 1.0
+
+    def __init__(self, root, rules):
+        """Create PollingWatcher object and take the first snapshot."""
+        super().__init__(root, rules)
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """Return {relpath: (size, mtime_ns)} for the files under root."""
+        return {relpath: (stat.st_size, stat.st_mtime_ns)
+                for _, relpath, stat in walk(self.root, self.rules)}
+
+    def poll(self, timeout):
+        """Walk the tree again after timeout (or INTERVAL) seconds."""
+        time.sleep(self.INTERVAL if timeout is None else timeout)
+        snapshot = self.scan()
+        changed = {relpath for relpath in snapshot.keys() | self.snapshot
+                   if snapshot.get(relpath) != self.snapshot.get(relpath)}
+        self.snapshot = snapshot
+        return changed
+
+
+class InotifyWatcher(Watcher):
+    """Find changes with a Linux inotify watch on every directory."""
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    def __init__(self, root, rules):
+        """Create InotifyWatcher object, watching the whole tree.
+
+        Raise OSError (or AttributeError where libc has no inotify) if
+        the tree cannot be watched.
+        """
+        super().__init__(root, rules)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        try:
+            self.add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, relpath):
+        """Watch the directory relpath, unless it has already gone."""
+        path = os.path.join(self.root, *relpath.split('/')) if relpath \
+            else self.root
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         self.MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error, 'cannot watch {}: {}'.format(
+                path, os.strerror(error)))
+        self.watches[wd] = relpath
+
+    def add_tree(self, relpath):
+        """Watch relpath and every directory under it sync does not skip."""
+        stack = [relpath]
+        while stack:
+            directory = stack.pop()
+            self.add_watch(directory)
+            path = os.path.join(self.root, *directory.split('/')) \
+                if directory else self.root
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        child = directory + '/' + entry.name if directory \
+                            else entry.name
+                        if (entry.is_dir(follow_symlinks=False) and
+                                not self.rules.ignored(child, True)):
+                            stack.append(child)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def remove_tree(self, relpath):
+        """Stop watching relpath and the directories under it."""
+        for wd, directory in list(self.watches.items()):
+            if directory == relpath or directory.startswith(relpath + '/'):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def poll(self, timeout):
+        """Read the inotify events that arrive within timeout seconds."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed.add('')
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            relpath = directory + '/' + name if directory else name
+            is_dir = bool(mask & IN_ISDIR)
+            if self.rules.ignored(relpath, is_dir):
+                continue
+            if is_dir:
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.remove_tree(relpath)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(relpath)
+                else:
+                    continue
+            changed.add(relpath)
+        return changed
+
+    def close(self):
+        """Stop watching and close the inotify descriptor."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch_tree(root, rules):
+    """Return an InotifyWatcher for root, or a PollingWatcher without one."""
+    try:
+        return InotifyWatcher(root, rules)
+    except (AttributeError, OSError, TypeError):
+        return PollingWatcher(root, rules)
@@ -13,17 +13,36 @@ Webotron automates the process of deploying static websites to AWS.
 - Configure Content Deliver Network and SSL with AWS CloudFront
 """
 
+import os
+import sys
+import tempfile
+
 import boto3
 import click
 
+from webotron.aiotransport import AsyncTransport
 from webotron.bucket import BucketManager
+from webotron.clients import ClientRegistry
+from webotron.compress import Precompressor
 from webotron.domain import DomainManager
 from webotron.certificate import CertificateManager
 from webotron.cdn import DistributionManager
-
-import webotron import util
+from webotron.cdnsetup import CdnSetup
+from webotron.etagcache import EtagCache
+from webotron.fanout import FanOut
+from webotron.fingerprint import Fingerprinter
+from webotron.journal import SyncJournal
+from webotron.manifest import Manifest
+from webotron.plan import SyncPlan
+from webotron.profiler import ThreadProfiler
+from webotron.policy import MetadataRules
+from webotron.stats import Stats
+from webotron.throttle import BandwidthLimiter
+
+from webotron import util
 
 SESSION = None
+CLIENTS = None
 bucket_manager = None
 domain_manager = None
 cert_manager = None
@@ -34,19 +53,56 @@ dist_manager = None
 @click.option('--profile',
               default=None,
               help="Use a given AWS profile.")
-def cli(profile):
+@click.option('--stats', 'stats_format',
+              type=click.Choice(Stats.FORMATS),
+              help="Report AWS calls, retries, bytes, latencies and phase "
+                   "timings when the command ends.")
+@click.option('--stats-file',
+              type=click.Path(dir_okay=False),
+              help="Write the --stats report to this file (such as a "
+                   "Prometheus textfile) instead of stdout.")
+@click.option('--cprofile',
+              type=click.Path(dir_okay=False),
+              help="Profile the command and its worker threads with "
+                   "cProfile and save the merged pstats data to this file.")
+@click.pass_context
+def cli(ctx, profile, stats_format, stats_file, cprofile):
     """Webotron deploys websites to AWS."""
-    global SESSION, bucket_manager, domain_manager, cert_manager, dist_manager
+    global SESSION, CLIENTS, bucket_manager, domain_manager, cert_manager
+    global dist_manager
 
     session_cfg = {}
     if profile:
         session_cfg['profile_name'] = profile
 
+    stats = Stats(enabled=bool(stats_format))
+    if stats_format:
+        ctx.call_on_close(
+            lambda: write_stats(stats, stats_format, stats_file))
+    if cprofile:
+        profiler = ThreadProfiler()
+        ctx.call_on_close(lambda: profiler.dump(cprofile))
+        profiler.start()
+
     SESSION = boto3.Session(**session_cfg)
-    bucket_manager = BucketManager(SESSION)
-    domain_manager = DomainManager(SESSION)
-    cert_manager = CertificateManager(SESSION)
-    dist_manager = DistributionManager(SESSION)
+    CLIENTS = ClientRegistry(SESSION, stats=stats)
+    bucket_manager = BucketManager(SESSION, clients=CLIENTS)
+    domain_manager = DomainManager(SESSION, CLIENTS)
+    cert_manager = CertificateManager(SESSION, CLIENTS)
+    dist_manager = DistributionManager(SESSION, CLIENTS)
+
+
+def write_stats(stats, stats_format, stats_file=None):
+    """Print the stats report, or replace stats_file with it."""
+    report = stats.report(stats_format)
+    if not stats_file:
+        print(report)
+        return
+    directory = os.path.dirname(os.path.abspath(stats_file))
+    with tempfile.NamedTemporaryFile('w', dir=directory,
+                                     delete=False) as staged:
+        staged.write(report)
+    os.replace(staged.name, stats_file)
 
 
 @cli.command('list-buckets')
@@ -58,9 +114,17 @@ def list_buckets():
 
 @cli.command('list-bucket-objects')
 @click.argument('bucket')
-def list_bucket_objects(bucket):
+@click.option('--prefix',
+              default='',
+              help="Only list keys starting with this prefix.")
+@click.option('--workers',
+              default=1,
+              type=click.IntRange(min=1),
+              help="Number of top level prefixes to list at once.")
+def list_bucket_objects(bucket, prefix, workers):
     """List objects in an S3 bucket."""
-    for obj in bucket_manager.all_objects(bucket):
+    CLIENTS.reserve(workers)
+    for obj in bucket_manager.all_objects(bucket, prefix, workers):
         print(obj)
 
 
@@ -77,11 +141,290 @@ def setup_bucket(bucket_name):
 
 @cli.command('sync')
 @click.argument('pathname', type=click.Path(exists=True))
-@click.argument('bucket_name')
-def sync(pathname, bucket_name):
-    """Sync contents of PATHNAME to BUCKET."""
-    bucket_manager.sync(pathname, bucket_name)
-    print(bucket_manager.get_bucket_url(bucket_manager.s3.Bucket(bucket_name)))
+@click.argument('bucket_names', nargs=-1, required=True)
+@click.option('--workers',
+              default=1,
+              type=click.IntRange(min=1),
+              help="Number of files to hash and upload (and bucket "
+                   "prefixes to list) at once.")
+@click.option('--prefix',
+              default='',
+              help="Sync into keys under this prefix, listing only that "
+                   "part of the bucket.")
+@click.option('--etag-cache',
+              default=EtagCache.DEFAULT_PATH,
+              type=click.Path(dir_okay=False),
+              help="File to cache local file ETags in between syncs.")
+@click.option('--no-etag-cache',
+              is_flag=True,
+              help="Hash every file, without reading or writing the cache.")
+@click.option('--remote-manifest',
+              is_flag=True,
+              help="Read and write a manifest object instead of listing "
+                   "the whole bucket.")
+@click.option('--spill-manifest',
+              is_flag=True,
+              help="Keep the bucket manifest in mmap'd temporary files "
+                   "instead of memory.")
+@click.option('--exclude',
+              multiple=True,
+              help="Leave out paths matching this glob (may be repeated).")
+@click.option('--include',
+              multiple=True,
+              help="Sync paths matching this glob even if excluded "
+                   "(may be repeated).")
+@click.option('--delete',
+              is_flag=True,
+              help="Delete keys that no longer have a local file.")
+@click.option('--max-delete',
+              default=1000,
+              type=click.IntRange(min=0),
+              help="Refuse to delete anything if more keys than this "
+                   "would be deleted.")
+@click.option('--max-bandwidth',
+              type=click.FloatRange(min=0.01),
+              help="Upload at most this many MiB per second in total.")
+@click.option('--watch',
+              is_flag=True,
+              help="After syncing, keep watching PATHNAME and sync each "
+                   "change as it happens.")
+@click.option('--resume',
+              is_flag=True,
+              help="Carry on from where an interrupted sync of the same "
+                   "directory, bucket and prefix stopped.")
+@click.option('--timings',
+              is_flag=True,
+              help="Print how long each stage of the sync took.")
+@click.option('--hash-threads',
+              type=click.IntRange(min=1),
+              help="Threads to hash the parts of one large file with "
+                   "(default: one per CPU).")
+@click.option('--dedup',
+              is_flag=True,
+              help="Copy files whose content is already in the bucket "
+                   "server side instead of uploading them.")
+@click.option('--metadata-rules',
+              type=click.Path(exists=True, dir_okay=False),
+              help="JSON file of glob -> Cache-Control and other upload "
+                   "arguments.")
+@click.option('--fingerprint',
+              is_flag=True,
+              help="Rename CSS, JS, images and fonts after their content, "
+                   "rewrite references to them and serve them as "
+                   "immutable.")
+@click.option('--precompress',
+              type=click.Choice(['gzip', 'br']),
+              help="Upload text files compressed with gzip or brotli "
+                   "(needs brotli), with their Content-Encoding set.")
+@click.option('--transport',
+              type=click.Choice(['threads', 'async']),
+              default='threads',
+              help="Upload with worker threads, or from one asyncio event "
+                   "loop (needs aiobotocore; no --dedup or "
+                   "--max-bandwidth).")
+@click.option('--max-requests',
+              default=256,
+              type=click.IntRange(min=1),
+              help="Most S3 requests in flight at once with "
+                   "--transport=async.")
+@click.option('--invalidate',
+              metavar='DOMAIN',
+              help="Invalidate the changed keys in the CloudFront "
+                   "distribution for DOMAIN.")
+@click.option('--max-invalidation-paths',
+              default=15,
+              type=click.IntRange(min=1),
+              help="Collapse invalidation paths to wildcards to stay "
+                   "within this many.")
+@click.option('--wait-invalidation',
+              is_flag=True,
+              help="Wait for the invalidation to complete.")
+@click.option('--plan',
+              is_flag=True,
+              help="Print what the sync would do without changing the "
+                   "bucket.")
+@click.option('--json', 'as_json',
+              is_flag=True,
+              help="Print the --plan as JSON, ready for --apply-plan.")
+@click.option('--apply-plan',
+              type=click.File('r'),
+              help="Make the changes in a plan saved with --plan --json.")
+def sync(pathname, bucket_names, workers, prefix, etag_cache, no_etag_cache,
+         remote_manifest, spill_manifest, exclude, include, delete,
+         max_delete, max_bandwidth, watch, resume, timings, hash_threads,
+         dedup, metadata_rules, fingerprint, precompress, transport,
+         max_requests, invalidate, max_invalidation_paths, wait_invalidation,
+         plan, as_json, apply_plan):
+    """Sync contents of PATHNAME to one or more buckets.
+
+    With several BUCKET_NAMES the tree is walked and hashed once and each
+    bucket is uploaded to at the same time.
+    """
+    bucket_name = bucket_names[0]
+    fan_out = None
+    CLIENTS.reserve(
+        workers * bucket_manager.transfer_config.max_concurrency)
+    if len(bucket_names) > 1 and (plan or apply_plan or watch or resume or
+                                  invalidate or transport == 'async'):
+        raise click.BadParameter(
+            'only one bucket can be used with --plan, --apply-plan, '
+            '--watch, --resume, --invalidate or --transport=async',
+            param_hint='BUCKET_NAMES')
+    if apply_plan:
+        saved_plan = SyncPlan.from_json(apply_plan.read())
+        if saved_plan.bucket_name != bucket_name:
+            print("Error, the plan is for bucket {}.".format(
+                saved_plan.bucket_name))
+            sys.exit(1)
+
+    if resume and (plan or apply_plan or transport == 'async'):
+        raise click.BadParameter(
+            'cannot be used with --plan, --apply-plan or --transport=async',
+            param_hint='--resume')
+    if watch and (plan or apply_plan or transport == 'async' or
+                  fingerprint):
+        raise click.BadParameter(
+            'cannot be used with --plan, --apply-plan, --fingerprint or '
+            '--transport=async', param_hint='--watch')
+    if transport == 'async' and (dedup or max_bandwidth):
+        raise click.BadParameter(
+            'cannot be used with --dedup or --max-bandwidth',
+            param_hint='--transport')
+    if max_bandwidth:
+        bucket_manager.bandwidth = BandwidthLimiter(
+            int(max_bandwidth * 1024 * 1024))
+    if hash_threads:
+        bucket_manager.hash_threads = hash_threads
+    bucket_manager.dedup = dedup
+    if metadata_rules:
+        try:
+            bucket_manager.metadata_rules = MetadataRules.from_file(
+                metadata_rules)
+        except ValueError as exception:
+            raise click.BadParameter(str(exception),
+                                     param_hint='--metadata-rules')
+    if fingerprint:
+        bucket_manager.fingerprinter = Fingerprinter.for_root(pathname)
+    if precompress:
+        try:
+            bucket_manager.precompressor = Precompressor(precompress)
+        except RuntimeError as exception:
+            raise click.BadParameter(str(exception),
+                                     param_hint='--precompress')
+    if spill_manifest:
+        bucket_manager.manifest = Manifest(spill=True)
+    if not no_etag_cache and not apply_plan:
+        bucket_manager.etag_cache = EtagCache(etag_cache)
+    options = dict(workers=workers, remote_manifest=remote_manifest,
+                   prefix=prefix, excludes=exclude, includes=include,
+                   delete=delete, max_deletes=max_delete)
+    try:
+        if plan:
+            sync_plan = bucket_manager.plan(pathname, bucket_name, **options)
+        elif apply_plan:
+            results = bucket_manager.apply_plan(saved_plan, workers=workers)
+        elif len(bucket_names) > 1:
+            fan_out = FanOut.for_buckets(bucket_manager, bucket_names,
+                                         progress=print)
+            results = fan_out.sync(pathname, **options)
+        elif watch:
+            bucket_manager.journal_dir = SyncJournal.DIRECTORY
+            try:
+                for results in bucket_manager.watch(pathname, bucket_name,
+                                                    **options):
+                    report_sync(bucket_manager, results, bucket_name, dedup,
+                                timings, invalidate, max_invalidation_paths,
+                                wait_invalidation)
+                    print('Watching {} for changes...'.format(pathname))
+            except KeyboardInterrupt:
+                pass
+            return
+        elif transport == 'async':
+            del options['workers']
+            results = AsyncTransport(bucket_manager, max_requests,
+                                     workers).sync(pathname, bucket_name,
+                                                   **options)
+        else:
+            bucket_manager.journal_dir = SyncJournal.DIRECTORY
+            results = bucket_manager.sync(pathname, bucket_name,
+                                          resume=resume, **options)
+    finally:
+        if bucket_manager.etag_cache is not None:
+            bucket_manager.etag_cache.close()
+
+    if plan:
+        if as_json:
+            print(sync_plan.to_json())
+        else:
+            print("\n".join(sync_plan.summary()))
+        return
+
+    if fan_out:
+        failed = False
+        for name, target_results in results.items():
+            print("{}:".format(name))
+            failed |= not report_sync(fan_out.managers[name], target_results,
+                                      name, dedup, timings, None, None, False)
+        if failed:
+            sys.exit(1)
+    elif not report_sync(bucket_manager, results, bucket_name, dedup,
+                         timings, invalidate, max_invalidation_paths,
+                         wait_invalidation):
+        sys.exit(1)
+
+
+def report_sync(manager, results, bucket_name, dedup, timings, invalidate,
+                max_invalidation_paths, wait_invalidation):
+    """Print the outcome of a sync and invalidate what it changed.
+
+    Return False if any file failed.
+    """
+    failed = [result for result in results if result.status == 'failed']
+    for result in failed:
+        print("Failed: {}: {}".format(result.key, result.error))
+    print("Uploaded {}, copied {}, skipped {}, deleted {}, failed {}".format(
+        sum(1 for result in results if result.status == 'uploaded'),
+        sum(1 for result in results if result.status == 'copied'),
+        sum(1 for result in results if result.status == 'skipped'),
+        sum(1 for result in results if result.status == 'deleted'),
+        len(failed)))
+    if dedup:
+        print("Copying instead of uploading saved {} bytes".format(
+            manager.bytes_saved))
+    if timings:
+        for stage in manager.stage_stats:
+            print("{}: {} items, {:.2f}s busy, {:.2f}s wall".format(
+                stage.name, stage.items, stage.busy, stage.wall))
+        limiter = manager.limiter
+        print("throttled: {} times, concurrency {} of {} (lowest {})".format(
+            limiter.throttles, limiter.current(), limiter.maximum,
+            limiter.lowest))
+        if manager.bandwidth:
+            print("bandwidth: waited {:.2f}s".format(
+                manager.bandwidth.waited))
+    print(manager.get_bucket_url(manager.s3.Bucket(bucket_name)))
+
+    if invalidate:
+        dist_manager.use_cache()
+        dist = dist_manager.find_matching_dist(invalidate)
+        if not dist:
+            print('Error, no distribution for {}.'.format(invalidate))
+            sys.exit(1)
+        invalidation = dist_manager.invalidate(
+            dist,
+            [result.key for result in results
+             if result.status in ('uploaded', 'copied', 'deleted')],
+            max_invalidation_paths)
+        if invalidation:
+            print("Invalidating {}: {}".format(
+                invalidation['Id'],
+                ' '.join(invalidation['InvalidationBatch']['Paths']
+                         .get('Items', []))))
+            if wait_invalidation:
+                print('Waiting for invalidation...')
+                dist_manager.await_invalidation(dist, invalidation)
+
+    return not failed
 
 
 @cli.command('setup-domain')
@@ -90,44 +433,70 @@ def setup_domain(domain):
     """Configure Domain to point to bucket."""
     bucket = bucket_manager.get_bucket(domain)
 
-    zone = domain_manager.find_hosted_zone(domain) \
-        or domain_manager.create_hosted_zone(domain)
+    domain_manager.use_cache()
+    zone = domain_manager.find_or_create_hosted_zone(domain)
     endpoint = util.get_endpoint(bucket_manager.get_region_name(bucket))
     domain_manager.create_s3_domain_record(zone, domain, endpoint)
     print("Domain configured: http://{}".format(domain))
 
 
 @cli.command('find-cert')
-@click.argument('domain')
-def find_cert(domain):
-    """Configure Domain to point to bucket."""
-    print(cert_manager.find_matching_cert(domain))
+@click.argument('domains', nargs=-1, required=True)
+@click.option('--refresh',
+              is_flag=True,
+              help="List the certificates again instead of using the "
+                   "cached list.")
+def find_cert(domains, refresh):
+    """Find the ACM certificate for each domain."""
+    cert_manager.use_cache()
+    if refresh:
+        cert_manager.load_index(refresh=True)
+    for domain in domains:
+        cert = cert_manager.find_matching_cert(domain)
+        if len(domains) == 1:
+            print(cert)
+        else:
+            print('{}: {}'.format(
+                domain, cert['CertificateArn'] if cert else None))
 
 
 @cli.command('setup-cdn')
-@click.argument('domain')
-@click.argument('bucket')
-def setup_cdn(domain, bucket):
+@click.argument('targets', nargs=-1, required=True,
+                metavar='DOMAIN BUCKET [DOMAIN BUCKET]...')
+@click.option('--refresh',
+              is_flag=True,
+              help="List distributions, certificates and zones again "
+                   "instead of using the cached lists.")
+@click.option('--no-wait',
+              is_flag=True,
+              help="Do not wait for new distributions to deploy.")
+@click.option('--workers',
+              default=8,
+              type=click.IntRange(min=1),
+              help="Number of domains to set up at once.")
+def setup_cdn(targets, refresh, no_wait, workers):
     """Configure CDN to point to S3 bucket."""
-    dist = dist_manager.find_matching_dist(domain)
-
-    if not dist:
-        cert = cert_manager.find_matching_cert(domain)
-        if not cert:  # SSL required at this time
-            print('Error, no matching cert.')
-            return
-
-        dist = dist_manager.create_dist(domain, cert)
-        print('Waiting for distribution deployment...')
-        dist_manager.await_deploy(dist)
-
-    zone = domain_manager.find_hosted_zone(domain) \
-        or domain_manager.create_hosted_zone(domain)
-
-    domain_manager.create_cf_domain_record(zone, domain, dist['DomainName'])
-    print("Domain configured: https://{}".format(domain))
-
-    return
+    if len(targets) % 2:
+        raise click.UsageError('Give a BUCKET for each DOMAIN.')
+    for manager in (cert_manager, dist_manager, domain_manager):
+        manager.use_cache()
+
+    setup = CdnSetup(dist_manager, domain_manager, cert_manager,
+                     progress=print)
+    results = setup.setup(list(zip(targets[::2], targets[1::2])),
+                          wait=not no_wait, refresh=refresh,
+                          workers=workers)
+    for result in results:
+        if result.status == 'failed':
+            print('Error, {}: {}.'.format(result.domain, result.error))
+        elif result.status == 'deploying':
+            print("Domain configured: https://{} (distribution {} is "
+                  "still deploying)".format(result.domain, result.dist['Id']))
+        else:
+            print("Domain configured: https://{}".format(result.domain))
+
+    if any(result.status == 'failed' for result in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':